@@ -1,7 +1,20 @@
+import hashlib
 import json
 import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import quote, urlparse
 
 import requests
+from requests.utils import requote_uri
 from requests_ntlm import HttpNtlmAuth
 
 headers = {
@@ -29,18 +42,333 @@ headers = {
     },
 }
 
+# Maps request types used by headers to the HTTP verbs expected inside a $batch changeset.
+batch_methods = {
+    "GET": "GET",
+    "POST": "POST",
+    "PUT": "PATCH",
+    "DELETE": "DELETE",
+}
+
+
+def _send_batch(session, base_url, digest, operations, refresh_digest=None, retry=None):
+    """
+    Helper function.
+    Sends a list of operations as a single OData $batch request.
+    Consecutive write operations are grouped in one changeset, GET operations are sent as separate parts.
+    Urls of the operations are percent-encoded, as the request line of a part cannot contain spaces.
+
+    :param session: Authenticated requests session.
+    :param base_url: Site url ending with "/".
+    :param digest: Digest value for the POST request.
+    :param operations: List of (request_type, query, data) tuples, query is relative to base_url.
+    :param refresh_digest: Optional, function returning a new digest value, the request is sent once more
+                           with it when the digest is rejected (403), e.g. because it expired.
+    :param retry: Optional, function sending the request passed to it and repeating it when it is throttled,
+                  e.g. SharePointConnector._retry_throttled.
+    :return: List of (status_code, response_data) tuples in the order of operations, None if request failed.
+    """
+    batch_boundary = "batch_{}".format(uuid.uuid4())
+    changeset_boundary = None
+    lines = []
+    for request_type, query, data in operations:
+        method = batch_methods[request_type]
+        if method == "GET":
+            if changeset_boundary is not None:
+                lines += ["--{}--".format(changeset_boundary), ""]
+                changeset_boundary = None
+            lines += [
+                "--{}".format(batch_boundary),
+                "Content-Type: application/http",
+                "Content-Transfer-Encoding: binary",
+                "",
+                "GET {} HTTP/1.1".format(requote_uri(base_url + query)),
+                "Accept: application/json;odata=verbose",
+                "",
+                "",
+            ]
+            continue
+        if changeset_boundary is None:
+            changeset_boundary = "changeset_{}".format(uuid.uuid4())
+            lines += [
+                "--{}".format(batch_boundary),
+                'Content-Type: multipart/mixed; boundary="{}"'.format(changeset_boundary),
+                "Content-Transfer-Encoding: binary",
+                "",
+            ]
+        lines += [
+            "--{}".format(changeset_boundary),
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary",
+            "",
+            "{} {} HTTP/1.1".format(method, requote_uri(base_url + query)),
+            "Accept: application/json;odata=verbose",
+            "Content-Type: application/json;odata=verbose",
+        ]
+        if method != "POST":
+            lines.append("If-Match: *")
+        lines += ["", json.dumps(data) if data is not None else "", ""]
+    if changeset_boundary is not None:
+        lines += ["--{}--".format(changeset_boundary), ""]
+    lines += ["--{}--".format(batch_boundary), ""]
+
+    body = "\r\n".join(lines).encode("utf-8")
+    request_headers = {
+        "Accept": "application/json;odata=verbose",
+        "X-RequestDigest": digest,
+        "Content-Type": 'multipart/mixed; boundary="{}"'.format(batch_boundary),
+    }
+    if retry is None:
+        def retry(send):
+            return send()
+
+    def send():
+        return session.post(base_url + "_api/$batch", headers=request_headers, data=body)
+
+    post = retry(send)
+    if post.status_code == 403 and refresh_digest is not None:
+        request_headers["X-RequestDigest"] = refresh_digest()
+        post = retry(send)
+    print("Batch of {} operations.".format(len(operations)))
+    print("POST: {}".format(post.status_code))
+    if post.status_code not in [200, 201, 202]:
+        print(post.content)
+        return None
+    return _parse_batch_response(post.text)
+
+
+def _parse_batch_response(text):
+    """
+    Helper function.
+    Splits a multipart $batch response into (status_code, response_data) tuples.
+
+    :param text: Body of the $batch response.
+    :return: List of (status_code, response_data) tuples.
+    """
+    results = []
+    for match in re.finditer(r"HTTP/1\.1 (\d{3}).*?\r?\n\r?\n(.*?)(?=\r?\n--)", text, re.S):
+        body = match.group(2).strip()
+        try:
+            body = json.loads(body) if body else None
+        except ValueError:
+            pass
+        if isinstance(body, dict) and "d" in body:
+            body = body["d"]
+        results.append((int(match.group(1)), body))
+    return results
+
+
+def _changed_properties(declared, current):
+    """
+    Helper function.
+    Returns declared properties which differ from the current ones.
+
+    :param declared: Dictionary of declared properties.
+    :param current: Dictionary of current properties, as returned by REST.
+    :return: Dictionary of changed properties.
+    """
+    return {
+        key: value for key, value in declared.items()
+        if key != "__metadata" and current.get(key) != value
+    }
+
+
+def _normalize_value(value):
+    """
+    Helper function.
+    Brings a field value to the form in which it is compared, so 1 and 1.0 are equal.
+    """
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, dict):
+        return {key: _normalize_value(item) for key, item in value.items() if key != "__metadata"}
+    if isinstance(value, (list, tuple)):
+        return [_normalize_value(item) for item in value]
+    return value
+
+
+def _record_key(value):
+    """
+    Helper function.
+    Returns hashable identity of a key field value.
+    """
+    return json.dumps(_normalize_value(value), sort_keys=True, default=str)
+
+
+def _record_hash(record, fields):
+    """
+    Helper function.
+    Returns hash of given fields of a record or list item.
+    """
+    values = [_normalize_value(record.get(field)) for field in fields]
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+# Stack of the thread which started the work run by the current thread, see _with_callers.
+_callers = threading.local()
+
+
+def _caller_stack(frame):
+    """
+    Helper function.
+    Returns (code, self) pairs of given frame and the frames calling it, followed by the stack
+    of the thread which started the work run by the current thread.
+    """
+    stack = []
+    while frame is not None:
+        stack.append((frame.f_code, frame.f_locals.get("self")))
+        frame = frame.f_back
+    return stack + getattr(_callers, "stack", [])
+
+
+def _with_callers(function):
+    """
+    Helper function.
+    Wraps a function run in a worker thread, so the stack of the calling thread stays known to it
+    and ConnectorProfiler credits its requests to the connector method which started it.
+    """
+    stack = _caller_stack(sys._getframe(1))
+
+    def run(*args, **kwargs):
+        previous = getattr(_callers, "stack", [])
+        _callers.stack = stack
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _callers.stack = previous
+    return run
+
+
+def _prefetch(pages, depth):
+    """
+    Helper function.
+    Downloads pages of a paged read in a background thread, at most depth pages ahead of the consumer.
+    The download stops when the returned generator is closed.
+
+    :param pages: Generator of pages.
+    :param depth: Number of pages downloaded ahead, 0 disables prefetching.
+    :return: Generator of pages.
+    """
+    if depth <= 0:
+        for page in pages:
+            yield page
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+            put((end, None))
+        except Exception as error:
+            put((end, error))
+        finally:
+            pages.close()
+
+    producer = threading.Thread(target=_with_callers(produce))
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            page, error = buffer.get()
+            if error is not None:
+                raise error
+            if page is end:
+                return
+            yield page
+    finally:
+        stop.set()
+
+
+def _endpoint_template(url, base_url):
+    """
+    Helper function.
+    Replaces names, ids and query values of a request url with placeholders,
+    so requests to the same endpoint can be grouped.
+    """
+    if url.startswith(base_url):
+        url = url[len(base_url):]
+    path, _, query = url.partition("?")
+    path = re.sub(r"'[^']*'", "'{}'", path)
+    path = re.sub(r"\(\d+\)", "({})", path)
+    if query:
+        path += "?" + "&".join(parameter.partition("=")[0] for parameter in query.split("&"))
+    return path
+
+
+def _lookup_ids(value):
+    """
+    Helper function.
+    Returns ids referenced by a lookup or person field value, single or multi value.
+    """
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return value.get("results", [])
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _quote_path(server_relative_url):
+    """
+    Helper function.
+    Escapes a server relative url for use inside a quoted REST parameter, e.g. GetFileByServerRelativeUrl('...').
+    """
+    return quote(server_relative_url.replace("'", "''"), safe="/'")
+
+
+def _column_value(value):
+    """
+    Helper function.
+    Converts a field value to a value stored in an SQLite column.
+    """
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
 
 class SharePointConnector:
     """
     Class responsible for performing most of common SharePoint Operations.
     Use also to authenticate access to the SharepointSite and to get a digest value for POST requests.
+
+    With coalesce_gets=True concurrent GET requests for the same url share one HTTP call. This saves requests
+    when many threads read the same data, but a thread may receive a response to a call which started before
+    its own preceding write, so it is off by default.
     """
 
-    def __init__(self, login, password, base_url, domain="eur"):
+    def __init__(self, login, password, base_url, domain="eur", coalesce_gets=False):
         self.session = requests.Session()
         self.base_url = base_url + "/"
         self.session.auth = HttpNtlmAuth("{}\\{}".format(domain, login), "{}".format(password))
         self.success_list = [200, 201, 202]
+        # Number of retries of throttled requests, see _post.
+        self.max_retries = 3
+        # Seconds after which batch() renews its digest value, SharePoint digests expire after 30 minutes by default.
+        self.digest_max_age = 600
+        # Files with expanded list item fields and versions by server relative url, see get_files_metadata.
+        self.file_metadata_cache = {}
+        # Concurrent GET requests for the same url share one HTTP call, see _get.
+        self.coalesce_gets = coalesce_gets
+        self.get_stats = {"requests": 0, "coalesced": 0}
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
 
     def get_all_lists(self):
         """
@@ -48,9 +376,8 @@ class SharePointConnector:
 
         :return: Returns a REST response.
         """
-        get = self.session.get(
-            self.base_url + "_api/web/lists?$top=5000",
-            headers=headers["GET"]
+        get = self._get(
+            self.base_url + "_api/web/lists?$top=5000"
         )
         print("Get all list.")
         print("GET: {}".format(get.status_code))
@@ -240,9 +567,8 @@ class SharePointConnector:
         :param list_guid: Required, individual id of Sharepoint List.
         :return: Returns a REST response.
         """
-        get = self.session.get(
-            self.base_url + "_api/web/lists(guid'{}')/views".format(list_guid),
-            headers=headers["GET"]
+        get = self._get(
+            self.base_url + "_api/web/lists(guid'{}')/views".format(list_guid)
         )
         print("Get all list.")
         print("GET: {}".format(get.status_code))
@@ -251,6 +577,53 @@ class SharePointConnector:
         else:
             return get.json()["d"]["results"]
 
+    def read_view(self, list_guid, view_guid, prefetch=0):
+        """
+        Yields rows of a list view using RenderListDataAsStream.
+        Filtering, sorting and field selection of the view are done by the server, pages follow the view RowLimit.
+
+        :param list_guid: Required, individual id of Sharepoint List.
+        :param view_guid: Required, individual id of Sharepoint View
+        :param prefetch: Optional, number of pages downloaded in the background while the current one is processed.
+        :return: Generator of rows with fields of the view.
+        :raises requests.HTTPError: When a page cannot be downloaded, instead of ending the read early.
+        """
+        for page in _prefetch(self._view_pages(list_guid, view_guid), prefetch):
+            for row in page:
+                yield row
+
+    def _view_pages(self, list_guid, view_guid):
+        request_headers = dict(headers["POST"])
+        request_headers["X-RequestDigest"] = self.digest()
+        data = {
+            "parameters": {
+                "__metadata": {"type": "SP.RenderListDataParameters"},
+                # SP.RenderListDataOptions: 2 - ListData
+                "RenderOptions": 2,
+                "DatesInUtc": True,
+            }
+        }
+        query = "?View={}".format(view_guid)
+        while query:
+            post = self._post(
+                self.base_url + "_api/web/lists(guid'{}')/RenderListDataAsStream{}".format(list_guid, query),
+                request_headers,
+                json.dumps(data)
+            )
+            print("Get view page of view GUID: {}".format(view_guid))
+            print("POST: {}".format(post.status_code))
+            if post.status_code not in self.success_list:
+                print(post.content)
+                raise requests.HTTPError(
+                    "Getting view page of view GUID: {} failed with status {}.".format(view_guid, post.status_code),
+                    response=post
+                )
+            page = post.json()
+            yield page["Row"]
+            query = page.get("NextHref")
+            if query and "View=" not in query:
+                query += "&View={}".format(view_guid)
+
     def add_fields_to_view(self, list_guid, view_guid, field_name):
         """
         Adds a specific field to the ListView.
@@ -338,9 +711,8 @@ class SharePointConnector:
         :param list_name: Required, name of the list from which items will be downloaded.
         :return: Returns REST response.
         """
-        get = self.session.get(
-            self.base_url + "_api/web/lists/GetByTitle('{}')".format(list_name) + "/items?$top=5000",
-            headers=headers["GET"]
+        get = self._get(
+            self.base_url + "_api/web/lists/GetByTitle('{}')".format(list_name) + "/items?$top=5000"
         )
         print("Get list items from {}.".format(list_name))
         print("GET: {}".format(get.status_code))
@@ -349,6 +721,138 @@ class SharePointConnector:
         else:
             return get.json()["d"]["results"]
 
+    def iter_list_items(self, list_name, select=None, filter=None, page_size=5000, prefetch=0):
+        """
+        Yields all List Items from Sharepoint List of given Name, following the server paging.
+
+        :param list_name: Required, name of the list from which items will be downloaded.
+        :param select: Optional, list of field names to download, by default all fields are downloaded.
+        :param filter: Optional, OData $filter expression.
+        :param page_size: Optional, number of items downloaded in one request.
+        :param prefetch: Optional, number of pages downloaded in the background while the current one is processed.
+        :return: Generator of list items.
+        :raises requests.HTTPError: When a page cannot be downloaded, instead of ending the read early.
+        """
+        query = "_api/web/lists/GetByTitle('{}')/items?$top={}".format(list_name, page_size)
+        if select:
+            query += "&$select={}".format(",".join(select))
+        if filter:
+            query += "&$filter={}".format(filter)
+        for page in self.iter_query_pages(query, prefetch):
+            for item in page:
+                yield item
+
+    def iter_query_pages(self, query, prefetch=0):
+        """
+        Yields pages of results of any collection query, e.g. items of a list addressed by GUID,
+        following the server paging.
+
+        :param query: Required, collection query relative to base_url, e.g. "_api/web/lists(guid'...')/items?$top=5000".
+        :param prefetch: Optional, number of pages downloaded in the background while the current one is processed.
+        :return: Generator of lists of results.
+        :raises requests.HTTPError: When a page cannot be downloaded, instead of ending the read early.
+        """
+        return _prefetch(self._query_pages(query), prefetch)
+
+    def _query_pages(self, query):
+        url = self.base_url + query
+        while url:
+            get = self._get(url)
+            print("Get page of {}.".format(query))
+            print("GET: {}".format(get.status_code))
+            if get.status_code not in self.success_list:
+                print(get.content)
+                raise requests.HTTPError(
+                    "Getting page of {} failed with status {}.".format(query, get.status_code),
+                    response=get
+                )
+            page = get.json()["d"]
+            yield page["results"]
+            url = page.get("__next")
+
+    def get_list_item_type(self, list_name):
+        """
+        Gets the entity type name used in __metadata of list items of given list.
+
+        :param list_name: Required, name of the list.
+        :return: Returns entity type name as String.
+        """
+        get = self._get(
+            self.base_url + "_api/web/lists/GetByTitle('{}')?$select=ListItemEntityTypeFullName".format(list_name)
+        )
+        print("Get list item type of {}.".format(list_name))
+        print("GET: {}".format(get.status_code))
+        if get.status_code not in self.success_list:
+            print(get.content)
+        else:
+            return get.json()["d"]["ListItemEntityTypeFullName"]
+
+    def get_list_fields(self, list_name):
+        """
+        Gets all fields of the list of given name.
+
+        :param list_name: Required, name of the list.
+        :return: Returns REST response.
+        """
+        get = self._get(
+            self.base_url + "_api/web/lists/GetByTitle('{}')/fields".format(list_name)
+        )
+        print("Get fields of {}.".format(list_name))
+        print("GET: {}".format(get.status_code))
+        if get.status_code not in self.success_list:
+            print(get.content)
+        else:
+            return get.json()["d"]["results"]
+
+    def get_list_change_token(self, list_name):
+        """
+        Gets the current change token of the list of given name.
+
+        :param list_name: Required, name of the list.
+        :return: Returns change token as String.
+        """
+        get = self._get(
+            self.base_url + "_api/web/lists/GetByTitle('{}')?$select=CurrentChangeToken".format(list_name)
+        )
+        print("Get change token of {}.".format(list_name))
+        print("GET: {}".format(get.status_code))
+        if get.status_code not in self.success_list:
+            print(get.content)
+        else:
+            return get.json()["d"]["CurrentChangeToken"]["StringValue"]
+
+    def get_list_item_changes(self, list_name, change_token):
+        """
+        Gets all item changes (adds, updates and deletes) made in the list since given change token.
+
+        :param list_name: Required, name of the list.
+        :param change_token: Required, change token from which changes are returned.
+        :return: Returns list of SP.ChangeItem REST responses.
+        """
+        changes = []
+        while True:
+            data = {
+                "query": {
+                    "__metadata": {"type": "SP.ChangeQuery"},
+                    "Item": True,
+                    "Add": True,
+                    "Update": True,
+                    "DeleteObject": True,
+                    "ChangeTokenStart": {"__metadata": {"type": "SP.ChangeToken"}, "StringValue": change_token},
+                }
+            }
+            page = self.custom_query(
+                "_api/web/lists/GetByTitle('{}')/GetChanges".format(list_name),
+                request_type="POST",
+                data=data
+            )
+            if page is None:
+                return None
+            if not page["results"]:
+                return changes
+            changes += page["results"]
+            change_token = page["results"][-1]["ChangeToken"]["StringValue"]
+
     def remove_all_fields_from_view(self, list_guid, view_guid):
         """
         Removes all fields from List view.
@@ -372,6 +876,159 @@ class SharePointConnector:
         else:
             return post.json()["d"]
 
+    def get_list_schemas(self, list_names):
+        """
+        Gets lists of given names together with their fields, views and view fields in a single request.
+
+        :param list_names: Required, list of list names.
+        :return: Returns dictionary of REST responses by list name, missing lists are not included.
+        """
+        get = self._get(
+            self.base_url + "_api/web/lists?$filter={}&$expand=Fields,Views,Views/ViewFields".format(
+                " or ".join("Title eq '{}'".format(list_name) for list_name in list_names)
+            )
+        )
+        print("Get schemas of {} lists.".format(len(list_names)))
+        print("GET: {}".format(get.status_code))
+        if get.status_code not in self.success_list:
+            print(get.content)
+        else:
+            return {sp_list["Title"]: sp_list for sp_list in get.json()["d"]["results"]}
+
+    def plan_list_schemas(self, schemas, current=None):
+        """
+        Compares declared list schemas with the live ones and returns operations needed to apply the difference.
+        Nothing is sent to SharePoint except a single request for the live schemas.
+
+        Schema example:
+            {
+                "Title": "Orders",
+                "Description": "Customer orders",
+                "fields": [
+                    {"Title": "Amount", "FieldTypeKind": 9},
+                    {"Title": "Notes", "FieldTypeKind": 3, "Required": False},
+                ],
+                "views": [
+                    {"Title": "All Items", "fields": ["LinkTitle", "Amount", "Notes"], "RowLimit": 100},
+                ],
+            }
+        Other keys of a schema, field or view are set as properties of SP.List, SP.Field and SP.View.
+        Existing field types are never changed.
+
+        :param schemas: Required, list of list schemas.
+        :param current: Optional, live schemas as returned by get_list_schemas.
+        :return: List of (request_type, query, data) operations accepted by batch().
+        """
+        if current is None:
+            current = self.get_list_schemas([schema["Title"] for schema in schemas])
+            if current is None:
+                return None
+        operations = []
+        for schema in schemas:
+            operations += self._plan_list_schema(schema, current.get(schema["Title"]))
+        return operations
+
+    def _plan_list_schema(self, schema, current):
+        list_name = schema["Title"]
+        list_query = "_api/web/lists/GetByTitle('{}')".format(list_name)
+        list_properties = {key: value for key, value in schema.items() if key not in ("fields", "views")}
+        operations = []
+
+        if current is None:
+            operations.append(("POST", "_api/web/lists", SharePointDataParser.list_data(list_properties)))
+            current_fields = {}
+            current_views = {}
+        else:
+            changed = _changed_properties(list_properties, current)
+            if changed:
+                changed["__metadata"] = {"type": "SP.List"}
+                operations.append(("PUT", list_query, changed))
+            current_fields = {}
+            for field in current["Fields"]["results"]:
+                current_fields[field["InternalName"]] = field
+                current_fields.setdefault(field["Title"], field)
+            current_views = {view["Title"]: view for view in current["Views"]["results"]}
+
+        for field in schema.get("fields", []):
+            existing = current_fields.get(field["Title"])
+            if existing is None:
+                data = {"__metadata": {"type": "SP.Field"}}
+                data.update(field)
+                operations.append(("POST", list_query + "/fields", data))
+                continue
+            changed = _changed_properties(
+                {key: value for key, value in field.items() if key not in ("__metadata", "FieldTypeKind")},
+                existing
+            )
+            if changed:
+                changed["__metadata"] = {"type": existing["__metadata"]["type"]}
+                operations.append((
+                    "PUT",
+                    list_query + "/fields/GetByInternalNameOrTitle('{}')".format(existing["InternalName"]),
+                    changed
+                ))
+
+        for view in schema.get("views", []):
+            view_query = list_query + "/views/GetByTitle('{}')".format(view["Title"])
+            view_properties = {key: value for key, value in view.items() if key != "fields"}
+            existing = current_views.get(view["Title"])
+            if existing is None:
+                data = {"__metadata": {"type": "SP.View"}}
+                data.update(view_properties)
+                operations.append(("POST", list_query + "/views", data))
+                view_fields = None
+            else:
+                changed = _changed_properties(view_properties, existing)
+                if changed:
+                    changed["__metadata"] = {"type": "SP.View"}
+                    operations.append(("PUT", view_query, changed))
+                view_fields = existing["ViewFields"]["Items"]["results"]
+            if "fields" in view and view_fields != view["fields"]:
+                operations.append(("POST", view_query + "/viewfields/removeallviewfields", None))
+                for field_name in view["fields"]:
+                    operations.append(
+                        ("POST", view_query + "/viewfields/addviewfield('{}')".format(field_name), None)
+                    )
+        return operations
+
+    def provision_lists(self, schemas, batch_size=100):
+        """
+        Creates or updates lists so they match declared schemas.
+        Only the difference against the live schema is applied, using batched requests.
+        See plan_list_schemas for the schema format.
+
+        :param schemas: Required, list of list schemas.
+        :param batch_size: Optional, maximum number of operations sent in one $batch request.
+        :return: List of ((request_type, query, data), status_code, response_data) tuples.
+            Lists which could not be created are reported by their creation and not provisioned further.
+        """
+        current = self.get_list_schemas([schema["Title"] for schema in schemas])
+        if current is None:
+            return None
+        failed = []
+        missing = [schema for schema in schemas if schema["Title"] not in current]
+        if missing:
+            # New lists come with default fields and views, so they are created first and the rest is
+            # planned against their real schema.
+            print("Create {} missing lists.".format(len(missing)))
+            creations = [("POST", "_api/web/lists", SharePointDataParser.list_data(
+                {key: value for key, value in schema.items() if key not in ("fields", "views")}
+            )) for schema in missing]
+            created = self.batch(creations, batch_size=batch_size)
+            failed_names = set()
+            for schema, operation, (status, data) in zip(missing, creations, created):
+                if status not in self.success_list:
+                    failed.append((operation, status, data))
+                    failed_names.add(schema["Title"])
+            schemas = [schema for schema in schemas if schema["Title"] not in failed_names]
+            current = self.get_list_schemas([schema["Title"] for schema in schemas])
+            if current is None:
+                return None
+        operations = self.plan_list_schemas(schemas, current)
+        print("Provision {} lists with {} operations.".format(len(schemas), len(operations)))
+        results = self.batch(operations, batch_size=batch_size)
+        return failed + [(operation, status, data) for operation, (status, data) in zip(operations, results)]
+
     def create_new_list_item(self, list_name, data=None):
         """
         Creates a new List item in the list of given name.
@@ -436,6 +1093,69 @@ class SharePointConnector:
         if delete.status_code not in self.success_list:
             print(delete.content)
 
+    def upsert(self, list_name, records, key_field, compare_fields=None, delete_missing=False, batch_size=100):
+        """
+        Reconciles list items with given records using key_field as the record identity.
+        Only the key and compared fields are downloaded, and only changed records are sent, in batched requests.
+
+        :param list_name: Required, name of the list to reconcile.
+        :param records: Required, iterable of dictionaries with field values, each containing key_field.
+        :param key_field: Required, name of the field identifying a record.
+        :param compare_fields: Optional, fields compared to detect updates, by default all fields of the records.
+                               Every record is compared only on the fields it contains.
+        :param delete_missing: Optional, deletes list items whose key is not present in records.
+        :param batch_size: Optional, maximum number of operations sent in one $batch request.
+        :return: Dictionary with numbers of inserted, updated, deleted and unchanged items and failed operations.
+        :raises requests.HTTPError: When the list cannot be read completely, nothing is written then.
+        """
+        records = list(records)
+        if compare_fields is None:
+            compare_fields = sorted({
+                key for record in records for key in record if key not in (key_field, "__metadata")
+            })
+        item_type = self.get_list_item_type(list_name)
+        if item_type is None:
+            return None
+
+        current = {}
+        for item in self.iter_list_items(list_name, select=["Id", key_field] + list(compare_fields)):
+            current.setdefault(
+                _record_key(item[key_field]),
+                (item["Id"], {field: _normalize_value(item.get(field)) for field in compare_fields})
+            )
+
+        items_query = "_api/web/lists/GetByTitle('{}')/items".format(list_name)
+        operations = []
+        seen = set()
+        unchanged = 0
+        for record in records:
+            key = _record_key(record[key_field])
+            seen.add(key)
+            data = {"__metadata": {"type": item_type}}
+            data.update(record)
+            # Only fields present in the record are compared, as only they are sent.
+            fields = [field for field in compare_fields if field in record]
+            if key not in current:
+                operations.append(("POST", items_query, data))
+            elif _record_hash(current[key][1], fields) != _record_hash(record, fields):
+                operations.append(("PUT", items_query + "({})".format(current[key][0]), data))
+            else:
+                unchanged += 1
+        if delete_missing:
+            for key, (item_id, _) in current.items():
+                if key not in seen:
+                    operations.append(("DELETE", items_query + "({})".format(item_id), None))
+
+        print("Upsert {} records into {}: {} changes.".format(len(records), list_name, len(operations)))
+        summary = {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": unchanged, "failed": []}
+        counters = {"POST": "inserted", "PUT": "updated", "DELETE": "deleted"}
+        for operation, (status, data) in zip(operations, self.batch(operations, batch_size=batch_size)):
+            if status in self.success_list + [204]:
+                summary[counters[operation[0]]] += 1
+            else:
+                summary["failed"].append((operation, status, data))
+        return summary
+
     # Add functions related to document libraries and lists attachments
     def get_folder_information(self, folder_name):
         """
@@ -444,9 +1164,8 @@ class SharePointConnector:
         :param folder_name:  Required, name of the folder
         :return: Returns REST response
         """
-        get = self.session.get(
-            self.base_url + "_api/web/GetFolderByServerRelativeUrl('/{}')".format(folder_name),
-            headers=headers["GET"]
+        get = self._get(
+            self.base_url + "_api/web/GetFolderByServerRelativeUrl('/{}')".format(folder_name)
         )
         print("Get information for {} folder.".format(folder_name))
         print("GET: {}".format(get.status_code))
@@ -465,12 +1184,11 @@ class SharePointConnector:
         :param destination_library: Required, folder/library where file exists.
         :return:
         """
-        get = self.session.get(
+        get = self._get(
             self.base_url + "_api/web/GetFolderByServerRelativeUrl('/{}')/Files('{}')/$value".format(
                 destination_library,
                 file_name
-            ),
-            headers=headers["GET"]
+            )
         )
         print("Get {} from {}.".format(file_name, destination_library))
         print("GET: {}".format(get.status_code))
@@ -486,11 +1204,10 @@ class SharePointConnector:
         :param folder_name: Required
         :return:
         """
-        get = self.session.get(
+        get = self._get(
             self.base_url + "_api/web/GetFolderByServerRelativeUrl('/{}')/Files".format(
                 folder_name
-            ),
-            headers=headers["GET"]
+            )
         )
         print("Get all files from {}.".format(folder_name))
         print("GET: {}".format(get.status_code))
@@ -499,6 +1216,125 @@ class SharePointConnector:
         else:
             return get.json()["d"]["results"]
 
+    def iter_folder_files(self, folder_name, page_size=500, prefetch=0):
+        """
+        Yields all files from given library/folder, downloading them in pages.
+
+        :param folder_name: Required
+        :param page_size: Optional, number of files downloaded in one request.
+        :param prefetch: Optional, number of pages downloaded in the background while the current one is processed.
+        :return: Generator of files.
+        :raises requests.HTTPError: When a page cannot be downloaded, instead of ending the read early.
+        """
+        for page in _prefetch(self._folder_file_pages(folder_name, page_size), prefetch):
+            for file in page:
+                yield file
+
+    def _folder_file_pages(self, folder_name, page_size):
+        skip = 0
+        while True:
+            get = self._get(
+                self.base_url + "_api/web/GetFolderByServerRelativeUrl('/{}')/Files?$top={}&$skip={}".format(
+                    folder_name,
+                    page_size,
+                    skip
+                )
+            )
+            print("Get files page from {}.".format(folder_name))
+            print("GET: {}".format(get.status_code))
+            if get.status_code not in self.success_list:
+                print(get.content)
+                raise requests.HTTPError(
+                    "Getting files page from {} failed with status {}.".format(folder_name, get.status_code),
+                    response=get
+                )
+            page = get.json()["d"]["results"]
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            skip += page_size
+
+    def get_files_metadata(self, folder_name, recursive=False, max_workers=4, batch_size=100):
+        """
+        Gets properties, list item fields and version history of all files in given library/folder.
+        Folders are listed concurrently and details are downloaded in batched requests.
+        Results are cached by file ETag, so repeated calls only download details of changed files.
+        Files whose details could not be downloaded are left out of the result.
+
+        :param folder_name: Required
+        :param recursive: Optional, includes files of subfolders, by default set to False.
+        :param max_workers: Optional, number of requests sent concurrently.
+        :param batch_size: Optional, maximum number of files downloaded in one $batch request.
+        :return: List of files with expanded ListItemAllFields and Versions.
+        :raises requests.HTTPError: When a folder cannot be listed, instead of leaving out the folder and its content.
+        """
+        files = []
+        folders = ["/" + folder_name.strip("/")]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while folders:
+                subfolders = []
+                for listing in executor.map(_with_callers(self._list_folder), folders):
+                    files += listing["Files"]["results"]
+                    if recursive:
+                        # The Forms folder of a library root is not a list item, folders of users always are.
+                        subfolders += [
+                            folder["ServerRelativeUrl"] for folder in listing["Folders"]["results"]
+                            if folder["Name"] != "Forms" or (folder.get("ListItemAllFields") or {}).get("Id")
+                        ]
+                folders = subfolders
+
+            changed = [
+                file["ServerRelativeUrl"] for file in files
+                if self.file_metadata_cache.get(file["ServerRelativeUrl"], (None,))[0] != file["ETag"]
+            ]
+            print("Get metadata of {} files, {} changed.".format(len(files), len(changed)))
+            if changed:
+                digest = self.digest()
+
+                def fetch(chunk):
+                    results = _send_batch(self.session, self.base_url, digest, [(
+                        "GET",
+                        "_api/web/GetFileByServerRelativeUrl('{}')?$expand=ListItemAllFields,Versions".format(
+                            _quote_path(url)
+                        ),
+                        None
+                    ) for url in chunk], retry=self._retry_throttled) or []
+                    return results + [(None, None)] * (len(chunk) - len(results))
+
+                chunks = [changed[start:start + batch_size] for start in range(0, len(changed), batch_size)]
+                for chunk, results in zip(chunks, executor.map(_with_callers(fetch), chunks)):
+                    for url, (status, data) in zip(chunk, results):
+                        if status in self.success_list:
+                            self.file_metadata_cache[url] = (data["ETag"], data)
+                        else:
+                            # Metadata of an earlier version of the file must not be returned.
+                            self.file_metadata_cache.pop(url, None)
+                            print("Get metadata of {} failed: {}".format(url, data))
+
+        return [
+            self.file_metadata_cache[file["ServerRelativeUrl"]][1] for file in files
+            if file["ServerRelativeUrl"] in self.file_metadata_cache
+        ]
+
+    def _list_folder(self, server_relative_url):
+        get = self._get(
+            self.base_url + "_api/web/GetFolderByServerRelativeUrl('{}')?$expand={}&$select={}".format(
+                _quote_path(server_relative_url),
+                "Files,Folders,Folders/ListItemAllFields",
+                "Files/ServerRelativeUrl,Files/ETag,Folders/ServerRelativeUrl,Folders/Name,Folders/ListItemAllFields/Id"
+            )
+        )
+        print("Get files and folders of {}.".format(server_relative_url))
+        print("GET: {}".format(get.status_code))
+        if get.status_code not in self.success_list:
+            print(get.content)
+            raise requests.HTTPError(
+                "Getting files and folders of {} failed with status {}.".format(server_relative_url, get.status_code),
+                response=get
+            )
+        return get.json()["d"]
+
     def create_new_file(self, file_path, destination_library):
         """
         Uploads a file to given library/folder.
@@ -654,6 +1490,150 @@ class SharePointConnector:
         else:
             return delete.json()["d"]
 
+    def copy_files(self, pairs, overwrite=True, max_workers=4):
+        """
+        Copies many files on the server side, file content is not downloaded.
+
+        :param pairs: Required, list of (source, target) file paths, e.g. ("Shared Documents/a.docx", "Archive/a.docx").
+        :param overwrite: Optional, overwrites existing target files, by default set to True.
+        :param max_workers: Optional, number of requests sent concurrently.
+        :return: List of dictionaries with source, target, status and error of every copy.
+        """
+        return self._transfer(
+            pairs,
+            lambda source, target: (
+                "_api/web/GetFileByServerRelativeUrl('{}')/CopyTo(strNewUrl='{}',bOverwrite={})".format(
+                    _quote_path("/" + source),
+                    _quote_path("/" + target),
+                    "true" if overwrite else "false"
+                ),
+                None
+            ),
+            "Copy file",
+            max_workers
+        )
+
+    def move_files(self, pairs, overwrite=True, max_workers=4):
+        """
+        Moves many files on the server side, file content is not downloaded.
+
+        :param pairs: Required, list of (source, target) file paths.
+        :param overwrite: Optional, overwrites existing target files, by default set to True.
+        :param max_workers: Optional, number of requests sent concurrently.
+        :return: List of dictionaries with source, target, status and error of every move.
+        """
+        return self._transfer(
+            pairs,
+            lambda source, target: (
+                "_api/web/GetFileByServerRelativeUrl('{}')/MoveTo(newUrl='{}',flags={})".format(
+                    _quote_path("/" + source),
+                    _quote_path("/" + target),
+                    1 if overwrite else 0
+                ),
+                None
+            ),
+            "Move file",
+            max_workers
+        )
+
+    def copy_folders(self, pairs, max_workers=4):
+        """
+        Copies many folders with their content on the server side.
+
+        :param pairs: Required, list of (source, target) folder paths, e.g. ("Shared Documents/2019", "Archive/2019").
+        :param max_workers: Optional, number of requests sent concurrently.
+        :return: List of dictionaries with source, target, status and error of every copy.
+        """
+        return self._transfer(
+            pairs,
+            lambda source, target: ("_api/SP.MoveCopyUtil.CopyFolder()", self._folder_pair_data(source, target)),
+            "Copy folder",
+            max_workers
+        )
+
+    def move_folders(self, pairs, max_workers=4):
+        """
+        Moves many folders with their content on the server side.
+
+        :param pairs: Required, list of (source, target) folder paths.
+        :param max_workers: Optional, number of requests sent concurrently.
+        :return: List of dictionaries with source, target, status and error of every move.
+        """
+        return self._transfer(
+            pairs,
+            lambda source, target: ("_api/SP.MoveCopyUtil.MoveFolder()", self._folder_pair_data(source, target)),
+            "Move folder",
+            max_workers
+        )
+
+    def _folder_pair_data(self, source, target):
+        host_url = "{0.scheme}://{0.netloc}/".format(urlparse(self.base_url))
+        return {"srcUrl": host_url + source, "destUrl": host_url + target}
+
+    def _transfer(self, pairs, build_request, description, max_workers):
+        """
+        Helper function.
+        Sends one POST request per (source, target) pair concurrently, sharing one digest value.
+
+        :param pairs: Required, list of (source, target) paths.
+        :param build_request: Required, function returning (query, data) of the request for a pair.
+        :param description: Required, description of the operation printed for every pair.
+        :param max_workers: Required, number of requests sent concurrently.
+        :return: List of dictionaries with source, target, status and error in the order of pairs.
+                 A pair whose request could not be sent has status None and the exception as error.
+        """
+        request_headers = dict(headers["POST"])
+        request_headers["X-RequestDigest"] = self.digest()
+
+        def transfer(pair):
+            source, target = pair
+            query, data = build_request(source, target)
+            print("{} '{}' to '{}'.".format(description, source, target))
+            try:
+                post = self._post(self.base_url + query, request_headers, None if data is None else json.dumps(data))
+            except requests.RequestException as error:
+                print("POST failed: {}".format(error))
+                return {"source": source, "target": target, "status": None, "error": error}
+            print("POST: {}".format(post.status_code))
+            outcome = {"source": source, "target": target, "status": post.status_code, "error": None}
+            if post.status_code not in self.success_list:
+                print(post.content)
+                outcome["error"] = post.content
+            return outcome
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(_with_callers(transfer), pairs))
+
+    def _post(self, url, request_headers, data=None):
+        """
+        Helper function.
+        Performs a POST request, retrying it when SharePoint throttles requests (429 or 503),
+        after the time given in Retry-After header or with exponential backoff.
+
+        :param url: Required, full url of the request.
+        :param request_headers: Required, headers of the request.
+        :param data: Optional, body of the request.
+        :return: Returns a REST response.
+        """
+        return self._retry_throttled(lambda: self.session.post(url, headers=request_headers, data=data))
+
+    def _retry_throttled(self, send):
+        """
+        Helper function.
+        Sends a request, repeating it up to max_retries times when SharePoint throttles requests (429 or 503).
+
+        :param send: Required, function sending the request and returning the response.
+        :return: Returns a REST response.
+        """
+        attempt = 0
+        while True:
+            response = send()
+            if response.status_code not in (429, 503) or attempt >= self.max_retries:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            time.sleep(int(retry_after) if retry_after.isdigit() else 2 ** attempt)
+            attempt += 1
+
     def get_list_item_attachments(self, list_name, item_id):
         """
         Retrieves the list of avalible attachments for given list item
@@ -662,12 +1642,11 @@ class SharePointConnector:
         :param item_id: Required
         :return: Returns REST response
         """
-        get = self.session.get(
+        get = self._get(
             self.base_url + "_api/web/lists/GetByTitle('{}')/items({})/AttachmentFiles/".format(
                 list_name,
                 item_id
-            ),
-            headers=headers["GET"]
+            )
         )
         print("Get attachments for item ID: {} from {} list.".format(list_name, item_id))
         print("GET: {}".format(get.status_code))
@@ -685,13 +1664,12 @@ class SharePointConnector:
         :param file_name: Required
         :return: Returns REST response.
         """
-        get = self.session.get(
+        get = self._get(
             self.base_url + "_api/web/lists/GetByTitle('{}')/items({})/AttachmentFiles('{}')/$value".format(
                 list_name,
                 item_id,
                 file_name
-            ),
-            headers=headers["GET"]
+            )
         )
         print("Get {} for item ID: {} from {} list.".format(file_name, list_name, item_id))
         print("GET: {}".format(get.status_code))
@@ -770,6 +1748,88 @@ class SharePointConnector:
         else:
             return put.json()["d"]
 
+    def search(self, query_text, select_properties=None, row_limit=500, sort_list=None, refinement_filters=None,
+               source_id=None, trim_duplicates=False, prefetch=0):
+        """
+        Yields results of a SharePoint Search query (KQL), following the result paging.
+
+        :param query_text: Required, KQL query, e.g. 'FileExtension:docx AND Path:"https://site/Shared Documents"'.
+        :param select_properties: Optional, list of managed properties returned for every result.
+        :param row_limit: Optional, number of results downloaded in one request.
+        :param sort_list: Optional, sorting, e.g. "LastModifiedTime:descending".
+        :param refinement_filters: Optional, refinement filter, e.g. 'FileType:equals("docx")'.
+        :param source_id: Optional, id of the result source.
+        :param trim_duplicates: Optional, removes duplicated results, by default set to False.
+        :param prefetch: Optional, number of pages downloaded in the background while the current one is processed.
+        :return: Generator of results as dictionaries of managed property values.
+        :raises requests.HTTPError: When a page cannot be downloaded, instead of ending the read early.
+        """
+        query = self._search_query(query_text, refinement_filters, source_id)
+        query += "&rowlimit={}&trimduplicates={}".format(row_limit, "true" if trim_duplicates else "false")
+        if select_properties:
+            query += "&selectproperties='{}'".format(",".join(select_properties))
+        if sort_list:
+            query += "&sortlist='{}'".format(quote(sort_list))
+        for page in _prefetch(self._search_pages(query), prefetch):
+            for row in page:
+                yield {cell["Key"]: cell["Value"] for cell in row["Cells"]["results"]}
+
+    def search_refiners(self, query_text, refiners, refinement_filters=None, source_id=None):
+        """
+        Gets refinement values (facets) of a SharePoint Search query computed by the server.
+
+        :param query_text: Required, KQL query.
+        :param refiners: Required, list of managed properties to refine by, e.g. ["FileType", "Author"].
+        :param refinement_filters: Optional, refinement filter.
+        :param source_id: Optional, id of the result source.
+        :return: Dictionary of refinement entries by refiner name.
+        """
+        get = self._get(
+            self.base_url + self._search_query(query_text, refinement_filters, source_id) +
+            "&rowlimit=0&refiners='{}'".format(",".join(refiners))
+        )
+        print("Get search refiners for {}.".format(query_text))
+        print("GET: {}".format(get.status_code))
+        if get.status_code not in self.success_list:
+            print(get.content)
+        else:
+            refinement_results = get.json()["d"]["query"]["PrimaryQueryResult"]["RefinementResults"]
+            if refinement_results is None:
+                return {}
+            return {
+                refiner["Name"]: refiner["Entries"]["results"]
+                for refiner in refinement_results["Refiners"]["results"]
+            }
+
+    @staticmethod
+    def _search_query(query_text, refinement_filters, source_id):
+        query = "_api/search/query?querytext='{}'".format(quote(query_text.replace("'", "''")))
+        if refinement_filters:
+            query += "&refinementfilters='{}'".format(quote(refinement_filters.replace("'", "''")))
+        if source_id:
+            query += "&sourceid='{}'".format(source_id)
+        return query
+
+    def _search_pages(self, query):
+        start_row = 0
+        while True:
+            get = self._get(self.base_url + query + "&startrow={}".format(start_row))
+            print("Get search results from row {}.".format(start_row))
+            print("GET: {}".format(get.status_code))
+            if get.status_code not in self.success_list:
+                print(get.content)
+                raise requests.HTTPError(
+                    "Getting search results from row {} failed with status {}.".format(start_row, get.status_code),
+                    response=get
+                )
+            results = get.json()["d"]["query"]["PrimaryQueryResult"]["RelevantResults"]
+            if not results["RowCount"]:
+                return
+            yield results["Table"]["Rows"]["results"]
+            start_row += results["RowCount"]
+            if start_row >= results["TotalRows"]:
+                return
+
     def custom_query(self, query, request_type="GET", data=None):
         """
         Allows to provide your API end point query
@@ -780,9 +1840,8 @@ class SharePointConnector:
         :return: returns REST response status
         """
         if request_type == "GET":
-            get = self.session.get(
-                self.base_url + query,
-                headers=headers["GET"]
+            get = self._get(
+                self.base_url + query
             )
             print("GET: {}".format(get.status_code))
             if get.status_code not in self.success_list:
@@ -833,6 +1892,80 @@ class SharePointConnector:
         else:
             raise AttributeError("Wrong request type.")
 
+    def batch(self, operations, batch_size=100):
+        """
+        Sends many operations in as few $batch requests as possible.
+        One digest value is shared by the requests, it is renewed after digest_max_age seconds
+        and when SharePoint rejects it.
+
+        :param operations: Required, list of (request_type, query, data) tuples.
+                           request_type is one of "GET", "POST", "PUT", "DELETE", query is relative to base_url.
+        :param batch_size: Optional, maximum number of operations sent in one $batch request.
+        :return: List of (status_code, response_data) tuples in the order of operations.
+        """
+        results = []
+        if not operations:
+            return results
+        digest = {"value": None, "time": 0}
+
+        def refresh_digest():
+            digest["value"] = self.digest()
+            digest["time"] = time.time()
+            return digest["value"]
+
+        for start in range(0, len(operations), batch_size):
+            chunk = operations[start:start + batch_size]
+            if time.time() - digest["time"] > self.digest_max_age:
+                refresh_digest()
+            response = _send_batch(
+                self.session, self.base_url, digest["value"], chunk, refresh_digest, self._retry_throttled
+            )
+            if response is None:
+                response = []
+            # Pads results of a failed or truncated batch so they still line up with operations.
+            response += [(None, None)] * (len(chunk) - len(response))
+            for (request_type, query, _), (status, data) in zip(chunk, response):
+                if status not in self.success_list + [204]:
+                    print("{} {} failed: {}".format(request_type, query, data))
+            results += response
+        return results
+
+    def _get(self, url):
+        """
+        Helper function.
+        Performs a GET request, retrying it when SharePoint throttles requests.
+        When coalesce_gets is set, concurrent requests for the same url share
+        one HTTP call and all of them receive its response. Counters are kept in get_stats.
+
+        :param url: Required, full url of the request.
+        :return: Returns a REST response.
+        """
+        if not self.coalesce_gets:
+            return self._retry_throttled(lambda: self.session.get(url, headers=headers["GET"]))
+        with self._in_flight_lock:
+            self.get_stats["requests"] += 1
+            call = self._in_flight.get(url)
+            follower = call is not None
+            if follower:
+                self.get_stats["coalesced"] += 1
+            else:
+                call = self._in_flight[url] = {"done": threading.Event(), "response": None, "error": None}
+        if follower:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["response"]
+        try:
+            call["response"] = self._retry_throttled(lambda: self.session.get(url, headers=headers["GET"]))
+        except Exception as error:
+            call["error"] = error
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[url]
+            call["done"].set()
+        return call["response"]
+
     def digest(self):
         """
         Helper function.
@@ -853,9 +1986,8 @@ class SharePointConnector:
 
         :return: Boolean
         """
-        data = self.session.get(
-            self.base_url,
-            headers=headers["GET"]
+        data = self._get(
+            self.base_url
         )
         if data.status_code == 200:
             return True
@@ -910,11 +2042,56 @@ class SharePointDataParser:
 
 
 class PermissionHandler:
-    def __init__(self, login, password, base_url, domain="eur"):
+    # SP.PermissionKind values, a permission of value n is bit n - 1 of the 64 bit permission mask.
+    permission_kinds = {
+        "EmptyMask": 0,
+        "ViewListItems": 1,
+        "AddListItems": 2,
+        "EditListItems": 3,
+        "DeleteListItems": 4,
+        "ApproveItems": 5,
+        "OpenItems": 6,
+        "ViewVersions": 7,
+        "DeleteVersions": 8,
+        "CancelCheckout": 9,
+        "ManagePersonalViews": 10,
+        "ManageLists": 12,
+        "ViewFormPages": 13,
+        "AnonymousSearchAccessList": 14,
+        "Open": 17,
+        "ViewPages": 18,
+        "AddAndCustomizePages": 19,
+        "ApplyThemeAndBorder": 20,
+        "ApplyStyleSheets": 21,
+        "ViewUsageData": 22,
+        "CreateSSCSite": 23,
+        "ManageSubwebs": 24,
+        "CreateGroups": 25,
+        "ManagePermissions": 26,
+        "BrowseDirectories": 27,
+        "BrowseUserInfo": 28,
+        "AddDelPrivateWebParts": 29,
+        "UpdatePersonalWebParts": 30,
+        "ManageWeb": 31,
+        "AnonymousSearchAccessWebLists": 32,
+        "UseClientIntegration": 37,
+        "UseRemoteAPIs": 38,
+        "ManageAlerts": 39,
+        "CreateAlerts": 40,
+        "EditMyUserInfo": 41,
+        "EnumeratePermissions": 63,
+        "FullMask": 65,
+    }
+
+    def __init__(self, login, password, base_url, domain="eur", cache_ttl=300):
         self.session = requests.Session()
         self.base_url = base_url + "/"
         self.session.auth = HttpNtlmAuth("{}\\{}".format(domain, login), "{}".format(password))
         self.success_list = [200, 201, 202]
+        # Effective permission masks by (login_name, list_name, item_id), kept for cache_ttl seconds.
+        self.cache_ttl = cache_ttl
+        self.permission_cache = {}
+        self._cache_lock = threading.Lock()
 
     def authenticate(self):
         """
@@ -931,3 +2108,1047 @@ class PermissionHandler:
             return True
         else:
             return False
+
+    def get_effective_permissions(self, login_name, list_name=None, item_id=None):
+        """
+        Gets the effective permission mask of a user for the site, a list or a list item.
+        Masks are cached for cache_ttl seconds.
+
+        :param login_name: Required, login name of the user, e.g. "i:0#.w|eur\\login".
+        :param list_name: Optional, name of the list, by default permissions for the site are returned.
+        :param item_id: Optional, an individual id of the item in the list.
+        :return: Tuple of (high, low) permission mask.
+        """
+        key = (login_name, list_name, item_id)
+        mask = self._cached(key)
+        if mask is not None:
+            return mask
+        get = self.session.get(
+            self.base_url + self._permissions_query(login_name, list_name, item_id),
+            headers=headers["GET"]
+        )
+        print("Get permissions of {} for {}.".format(login_name, list_name or "site"))
+        print("GET: {}".format(get.status_code))
+        if get.status_code not in self.success_list:
+            print(get.content)
+        else:
+            return self._cache(key, get.json()["d"]["GetUserEffectivePermissions"])
+
+    def has_permission(self, login_name, permission, list_name=None, item_id=None):
+        """
+        Checks whether a user has a permission for the site, a list or a list item.
+
+        :param login_name: Required, login name of the user.
+        :param permission: Required, name of SP.PermissionKind, e.g. "EditListItems".
+        :param list_name: Optional, name of the list.
+        :param item_id: Optional, an individual id of the item in the list.
+        :return: Boolean
+        """
+        mask = self.get_effective_permissions(login_name, list_name, item_id)
+        return mask is not None and self.mask_has_permission(mask, permission)
+
+    def check_permissions(self, checks, permission):
+        """
+        Checks a permission for many (login_name, list_name, item_id) tuples.
+        Masks missing in the cache are downloaded in batched requests.
+
+        :param checks: Required, list of (login_name, list_name, item_id) tuples, list_name and item_id may be None.
+        :param permission: Required, name of SP.PermissionKind.
+        :return: List of Booleans in the order of checks.
+        """
+        self._resolve(set(tuple(check) for check in checks if self._cached(tuple(check)) is None))
+        results = []
+        for check in checks:
+            mask = self._cached(tuple(check))
+            results.append(mask is not None and self.mask_has_permission(mask, permission))
+        return results
+
+    def prefetch_item_permissions(self, login_name, list_name):
+        """
+        Caches effective permissions of a user for all items of a list.
+        Only items with unique permissions are checked, in batched requests. Other items take the mask of
+        the nearest parent folder with unique permissions, or the list mask when there is none.
+
+        :param login_name: Required, login name of the user.
+        :param list_name: Required, name of the list.
+        :return: Number of cached items.
+        """
+        list_mask = self.get_effective_permissions(login_name, list_name)
+        if list_mask is None:
+            return None
+        items = []
+        unique_folders = {}
+        url = self.base_url + "_api/web/lists/GetByTitle('{}')/items?$select={}&$top=5000".format(
+            list_name,
+            "Id,HasUniqueRoleAssignments,FileRef,FileDirRef,FSObjType"
+        )
+        while url:
+            get = self.session.get(url, headers=headers["GET"])
+            print("Get permission inheritance of items in {}.".format(list_name))
+            print("GET: {}".format(get.status_code))
+            if get.status_code not in self.success_list:
+                print(get.content)
+                return None
+            page = get.json()["d"]
+            for item in page["results"]:
+                items.append(item)
+                # FSObjType: 1 - folder
+                if item["HasUniqueRoleAssignments"] and str(item.get("FSObjType")) == "1":
+                    unique_folders[item["FileRef"]] = item["Id"]
+            url = page.get("__next")
+
+        self._resolve({(login_name, list_name, item["Id"]) for item in items if item["HasUniqueRoleAssignments"]})
+        count = 0
+        for item in items:
+            if item["HasUniqueRoleAssignments"]:
+                count += self._cached((login_name, list_name, item["Id"])) is not None
+                continue
+            mask = list_mask
+            folder = item.get("FileDirRef") or ""
+            while folder:
+                if folder in unique_folders:
+                    mask = self._cached((login_name, list_name, unique_folders[folder]))
+                    break
+                folder = folder.rpartition("/")[0]
+            # Items of a folder which permissions could not be read are left out of the cache.
+            if mask is not None:
+                self._cache((login_name, list_name, item["Id"]), mask)
+                count += 1
+        return count
+
+    def get_role_assignments(self, list_name=None, item_id=None):
+        """
+        Gets role assignments with their members and role definitions for the site, a list or a list item.
+
+        :param list_name: Optional, name of the list.
+        :param item_id: Optional, an individual id of the item in the list.
+        :return: Returns REST response.
+        """
+        get = self.session.get(
+            self.base_url + self._securable_query(list_name, item_id) +
+            "/roleassignments?$expand=Member,RoleDefinitionBindings",
+            headers=headers["GET"]
+        )
+        print("Get role assignments for {}.".format(list_name or "site"))
+        print("GET: {}".format(get.status_code))
+        if get.status_code not in self.success_list:
+            print(get.content)
+        else:
+            return get.json()["d"]["results"]
+
+    def clear_cache(self, login_name=None):
+        """
+        Removes cached permission masks, of all users or of a given one.
+
+        :param login_name: Optional, login name of the user.
+        """
+        with self._cache_lock:
+            if login_name is None:
+                self.permission_cache.clear()
+            else:
+                for key in [key for key in self.permission_cache if key[0] == login_name]:
+                    del self.permission_cache[key]
+
+    @classmethod
+    def mask_has_permission(cls, mask, permission):
+        """
+        Checks whether a (high, low) permission mask contains a permission.
+
+        :param mask: Required, tuple of (high, low) permission mask.
+        :param permission: Required, name of SP.PermissionKind.
+        :return: Boolean
+        """
+        high, low = mask
+        kind = cls.permission_kinds[permission]
+        if kind == cls.permission_kinds["FullMask"]:
+            return high & 0x7FFFFFFF == 0x7FFFFFFF and low & 0xFFFFFFFF == 0xFFFFFFFF
+        if kind == cls.permission_kinds["EmptyMask"]:
+            return True
+        bit = kind - 1
+        if bit < 32:
+            return bool(low & (1 << bit))
+        return bool(high & (1 << (bit - 32)))
+
+    @classmethod
+    def decode_permissions(cls, mask):
+        """
+        Lists permissions contained in a (high, low) permission mask.
+
+        :param mask: Required, tuple of (high, low) permission mask.
+        :return: List of SP.PermissionKind names.
+        """
+        return [
+            permission for permission in cls.permission_kinds
+            if permission not in ("EmptyMask", "FullMask") and cls.mask_has_permission(mask, permission)
+        ]
+
+    def digest(self):
+        """
+        Helper function.
+        Gets a digest value for POST requests.
+
+        :return: Returns a REST response.
+        """
+        data = self.session.post(
+            self.base_url + "_api/contextinfo",
+            headers=headers["GET"]
+        )
+        return data.json()["d"]["GetContextWebInformation"]["FormDigestValue"]
+
+    def _resolve(self, keys, batch_size=100):
+        keys = list(keys)
+        if not keys:
+            return
+        digest = self.digest()
+        for start in range(0, len(keys), batch_size):
+            chunk = keys[start:start + batch_size]
+            results = _send_batch(
+                self.session,
+                self.base_url,
+                digest,
+                [("GET", self._permissions_query(*key), None) for key in chunk]
+            ) or []
+            for key, (status, data) in zip(chunk, results):
+                if status in self.success_list:
+                    self._cache(key, data["GetUserEffectivePermissions"])
+                else:
+                    print("Permissions of {} for {} item {} failed: {}".format(key[0], key[1], key[2], data))
+
+    def _cached(self, key):
+        with self._cache_lock:
+            entry = self.permission_cache.get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def _cache(self, key, mask):
+        if isinstance(mask, dict):
+            mask = (int(mask["High"]), int(mask["Low"]))
+        with self._cache_lock:
+            self.permission_cache[key] = (time.time() + self.cache_ttl, mask)
+        return mask
+
+    @staticmethod
+    def _securable_query(list_name, item_id):
+        query = "_api/web"
+        if list_name is not None:
+            query += "/lists/GetByTitle('{}')".format(list_name)
+            if item_id is not None:
+                query += "/items({})".format(item_id)
+        return query
+
+    def _permissions_query(self, login_name, list_name=None, item_id=None):
+        return self._securable_query(list_name, item_id) + "/GetUserEffectivePermissions(@user)?@user='{}'".format(
+            quote(login_name.replace("'", "''"), safe="")
+        )
+
+
+class ListReplica:
+    """
+    Local SQLite replica of SharePoint lists.
+    Lists are mirrored once and then refreshed incrementally using list change tokens.
+    Reads are served locally, writes go through to SharePoint and are applied to the replica.
+    """
+
+    # SQLite column types by SharePoint FieldTypeKind, fields of other types are kept only in the item JSON.
+    column_types = {
+        1: "INTEGER",   # Integer
+        2: "TEXT",      # Text
+        3: "TEXT",      # Note
+        4: "TEXT",      # DateTime
+        5: "INTEGER",   # Counter
+        6: "TEXT",      # Choice
+        7: "INTEGER",   # Lookup
+        8: "INTEGER",   # Boolean
+        9: "REAL",      # Number
+        10: "REAL",     # Currency
+        14: "TEXT",     # Guid
+        20: "INTEGER",  # User
+    }
+
+    def __init__(self, connector, path=":memory:"):
+        """
+        :param connector: Required, SharePointConnector used to read and write lists.
+        :param path: Optional, path of the SQLite database file, by default the replica is kept in memory.
+        """
+        self.connector = connector
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS replica_lists ("
+            "list_name TEXT PRIMARY KEY, table_name TEXT, columns TEXT, item_type TEXT, "
+            "change_token TEXT, refreshed_at REAL)"
+        )
+        self.db.commit()
+
+    def mirror(self, list_name, index=None):
+        """
+        Downloads the whole list into the replica, replacing an earlier copy.
+        Columns are derived from the list fields, indexed fields get an SQLite index.
+        Items are downloaded into a staging table, the earlier copy stays readable until the download is complete.
+
+        :param list_name: Required, name of the list.
+        :param index: Optional, additional field names to index.
+        :return: Number of mirrored items.
+        :raises requests.HTTPError: When the list cannot be read completely, the earlier copy is kept then.
+        """
+        fields = self.connector.get_list_fields(list_name)
+        item_type = self.connector.get_list_item_type(list_name)
+        # The token is taken before the download, changes made meanwhile are replayed by the next refresh.
+        change_token = self.connector.get_list_change_token(list_name)
+        if fields is None or item_type is None or change_token is None:
+            return None
+
+        columns = {}
+        indexed = set(index or [])
+        for field in fields:
+            if field.get("Hidden") or field["FieldTypeKind"] not in self.column_types:
+                continue
+            name = field.get("EntityPropertyName") or field["InternalName"]
+            if field["FieldTypeKind"] in (7, 20):
+                if field.get("AllowMultipleValues"):
+                    continue
+                name += "Id"
+            if name.lower() == "id":
+                continue
+            columns[name] = self.column_types[field["FieldTypeKind"]]
+            if field.get("Indexed"):
+                indexed.add(name)
+        columns["Id"] = "INTEGER"
+
+        table_name = "list_" + re.sub(r"\W", "_", list_name)
+        staging_name = table_name + "_staging"
+        with self.lock:
+            self.db.execute('DROP TABLE IF EXISTS "{}"'.format(staging_name))
+            self.db.execute('CREATE TABLE "{}" ({}, item TEXT)'.format(
+                staging_name,
+                ", ".join(
+                    '"{}" {}{}'.format(name, column_type, " PRIMARY KEY" if name == "Id" else "")
+                    for name, column_type in columns.items()
+                )
+            ))
+            self.db.commit()
+
+        count = 0
+        try:
+            page = []
+            for item in self.connector.iter_list_items(list_name):
+                page.append(item)
+                if len(page) >= 1000:
+                    with self.lock:
+                        count += self._insert(staging_name, columns, page)
+                    page = []
+            with self.lock:
+                count += self._insert(staging_name, columns, page)
+        except Exception:
+            with self.lock:
+                self.db.rollback()
+                self.db.execute('DROP TABLE IF EXISTS "{}"'.format(staging_name))
+                self.db.commit()
+            raise
+
+        with self.lock:
+            self.db.execute('DROP TABLE IF EXISTS "{}"'.format(table_name))
+            self.db.execute('ALTER TABLE "{}" RENAME TO "{}"'.format(staging_name, table_name))
+            for name in indexed:
+                if name in columns and name != "Id":
+                    self.db.execute('CREATE INDEX "{0}_{1}" ON "{0}" ("{1}")'.format(table_name, name))
+            self.db.execute(
+                "INSERT OR REPLACE INTO replica_lists VALUES (?, ?, ?, ?, ?, ?)",
+                (list_name, table_name, json.dumps(columns), item_type, change_token, time.time())
+            )
+            self.db.commit()
+        print("Mirrored {} items of {}.".format(count, list_name))
+        return count
+
+    def refresh(self, list_name):
+        """
+        Applies changes made in the list since the last mirror or refresh.
+        Only changed items are downloaded.
+
+        :param list_name: Required, name of the mirrored list.
+        :return: Dictionary with numbers of updated and deleted items.
+        """
+        meta = self._meta(list_name)
+        changes = self.connector.get_list_item_changes(list_name, meta["change_token"])
+        if changes is None:
+            return None
+        changed = set()
+        deleted = set()
+        for change in changes:
+            # SP.ChangeType: 3 - DeleteObject
+            if change["ChangeType"] == 3:
+                deleted.add(change["ItemId"])
+                changed.discard(change["ItemId"])
+            else:
+                changed.add(change["ItemId"])
+        items = list(self._download(list_name, changed))
+        with self.lock:
+            self._delete(list_name, deleted)
+            self._store(list_name, items)
+            if changes:
+                meta["change_token"] = changes[-1]["ChangeToken"]["StringValue"]
+            self.db.execute(
+                "UPDATE replica_lists SET change_token = ?, refreshed_at = ? WHERE list_name = ?",
+                (meta["change_token"], time.time(), list_name)
+            )
+            self.db.commit()
+        print("Refreshed {}: {} updated, {} deleted.".format(list_name, len(changed), len(deleted)))
+        return {"updated": len(changed), "deleted": len(deleted)}
+
+    def staleness(self):
+        """
+        Reports how long ago each mirrored list was refreshed.
+
+        :return: Dictionary of seconds since the last refresh by list name.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT list_name, refreshed_at FROM replica_lists").fetchall()
+        now = time.time()
+        return {row["list_name"]: now - row["refreshed_at"] for row in rows if row["refreshed_at"] is not None}
+
+    def query(self, list_name, where=None, params=(), order_by=None, limit=None):
+        """
+        Queries the replica of a list.
+
+        :param list_name: Required, name of the mirrored list.
+        :param where: Optional, SQL condition on list columns, e.g. '"Status" = ? AND "Amount" > ?'.
+        :param params: Optional, parameters of the condition.
+        :param order_by: Optional, SQL ORDER BY expression.
+        :param limit: Optional, maximum number of returned items.
+        :return: List of items, in the form returned by get_list_items.
+        """
+        sql = 'SELECT item FROM "{}"'.format(self._meta(list_name)["table_name"])
+        if where:
+            sql += " WHERE " + where
+        if order_by:
+            sql += " ORDER BY " + order_by
+        if limit:
+            sql += " LIMIT {}".format(int(limit))
+        with self.lock:
+            rows = self.db.execute(sql, tuple(params)).fetchall()
+        return [json.loads(row["item"]) for row in rows]
+
+    def get_item(self, list_name, item_id):
+        """
+        Gets a single item from the replica of a list.
+
+        :param list_name: Required, name of the mirrored list.
+        :param item_id: Required, an individual id of the item in the list.
+        :return: List item or None.
+        """
+        items = self.query(list_name, '"Id" = ?', (item_id,))
+        return items[0] if items else None
+
+    def lookup(self, list_name, field_name, value):
+        """
+        Gets items of which given field is equal to value.
+
+        :param list_name: Required, name of the mirrored list.
+        :param field_name: Required, column name.
+        :param value: Required, value to look for.
+        :return: List of items.
+        """
+        return self.query(list_name, '"{}" = ?'.format(field_name), (_column_value(value),))
+
+    def write(self, list_name, creates=(), updates=(), deletes=()):
+        """
+        Writes items to SharePoint in batched requests and applies successful writes to the replica.
+
+        :param list_name: Required, name of the mirrored list.
+        :param creates: Optional, list of dictionaries with field values of new items.
+        :param updates: Optional, list of (item_id, data) tuples.
+        :param deletes: Optional, list of item ids.
+        :return: List of (status_code, response_data) tuples in the order creates, updates, deletes.
+        """
+        meta = self._meta(list_name)
+        items_query = "_api/web/lists/GetByTitle('{}')/items".format(list_name)
+        operations = []
+        for data in creates:
+            operations.append(("POST", items_query, dict(data, __metadata={"type": meta["item_type"]})))
+        for item_id, data in updates:
+            operations.append(("PUT", items_query + "({})".format(item_id), dict(data, __metadata={
+                "type": meta["item_type"]
+            })))
+        for item_id in deletes:
+            operations.append(("DELETE", items_query + "({})".format(item_id), None))
+        results = self.connector.batch(operations)
+
+        created = []
+        updated = set()
+        deleted = set()
+        for (request_type, query, _), (status, data), item_id in zip(
+                operations, results, [None] * len(creates) + [update[0] for update in updates] + list(deletes)):
+            if status not in self.connector.success_list + [204]:
+                continue
+            if request_type == "POST":
+                created.append(data)
+            elif request_type == "PUT":
+                updated.add(item_id)
+            else:
+                deleted.add(item_id)
+        items = list(self._download(list_name, updated))
+        with self.lock:
+            self._store(list_name, created)
+            self._delete(list_name, deleted)
+            self._store(list_name, items)
+            self.db.commit()
+        return results
+
+    def _meta(self, list_name):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM replica_lists WHERE list_name = ?", (list_name,)).fetchone()
+        if row is None:
+            raise AttributeError("List {} is not mirrored.".format(list_name))
+        meta = dict(row)
+        meta["columns"] = json.loads(meta["columns"])
+        return meta
+
+    def _download(self, list_name, item_ids, chunk_size=50):
+        item_ids = sorted(item_ids)
+        for start in range(0, len(item_ids), chunk_size):
+            for item in self.connector.iter_list_items(
+                    list_name,
+                    filter=" or ".join("Id eq {}".format(item_id) for item_id in item_ids[start:start + chunk_size])
+            ):
+                yield item
+
+    def _store(self, list_name, items):
+        meta = self._meta(list_name)
+        return self._insert(meta["table_name"], meta["columns"], items)
+
+    def _insert(self, table_name, columns, items):
+        columns = list(columns)
+        sql = 'INSERT OR REPLACE INTO "{}" ({}, item) VALUES ({})'.format(
+            table_name,
+            ", ".join('"{}"'.format(name) for name in columns),
+            ", ".join("?" * (len(columns) + 1))
+        )
+        count = 0
+        for item in items:
+            self.db.execute(sql, [_column_value(item.get(name)) for name in columns] + [json.dumps(item)])
+            count += 1
+        return count
+
+    def _delete(self, list_name, item_ids):
+        table_name = self._meta(list_name)["table_name"]
+        self.db.executemany('DELETE FROM "{}" WHERE "Id" = ?'.format(table_name), [(item_id,) for item_id in item_ids])
+
+
+class ConnectorProfiler:
+    """
+    Records every HTTP request made by a SharePointConnector within a with block.
+    Requests are grouped by endpoint and calling method, and repeated per item calls with
+    a known bulk alternative are reported.
+
+    Usage:
+        with ConnectorProfiler(connector) as profiler:
+            ...
+        print(profiler.report())
+    """
+
+    # Bulk alternatives of connector methods, suggested when a method is called repeatedly.
+    bulk_alternatives = {
+        "digest": "batch(), which sends many writes with a single digest value",
+        "create_new_list_item": "upsert() or batch()",
+        "update_list_item": "upsert() or batch()",
+        "delete_list_item": "upsert(delete_missing=True) or batch()",
+        "create_new_list_field": "provision_lists()",
+        "add_fields_to_view": "provision_lists()",
+        "change_field_index_in_view": "provision_lists()",
+        "remove_fields_from_view": "provision_lists()",
+        "get_list_item_attachments": "$expand=AttachmentFiles on the items query",
+        "get_list_items": "ListReplica or iter_list_items(select=...)",
+        "get_file": "copy_files() or move_files() when the file is stored again",
+        "create_new_file": "copy_files() when the content comes from another library",
+        "delete_file": "move_files() when the file was copied before",
+        "get_files_from_folder": "search() or iter_folder_files()",
+        "custom_query": "batch()",
+    }
+
+    def __init__(self, connector, repeat_threshold=5, print_report=True):
+        """
+        :param connector: Required, SharePointConnector to profile.
+        :param repeat_threshold: Optional, number of calls of one method and endpoint reported as a per item pattern.
+        :param print_report: Optional, prints the report when the with block ends, by default set to True.
+        """
+        self.connector = connector
+        self.repeat_threshold = repeat_threshold
+        self.print_report = print_report
+        self.calls = []
+        self.wall_time = 0
+        self._lock = threading.Lock()
+        self._started = None
+        self._request = None
+        self._nested = False
+
+    def __enter__(self):
+        self.calls = []
+        self._started = time.time()
+        self._request = self.connector.session.request
+        # Another profiler may already wrap the session, it is restored on exit.
+        self._nested = "request" in vars(self.connector.session)
+        self.connector.session.request = self._record
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._nested:
+            self.connector.session.request = self._request
+        else:
+            del self.connector.session.request
+        self.wall_time = time.time() - self._started
+        if self.print_report:
+            print(self.report())
+        return False
+
+    def groups(self):
+        """
+        Groups recorded requests by calling method, HTTP method and endpoint.
+
+        :return: List of dictionaries sorted by number of requests.
+        """
+        groups = {}
+        with self._lock:
+            calls = list(self.calls)
+        for call in calls:
+            key = (call["caller"], call["method"], call["endpoint"])
+            group = groups.setdefault(key, {
+                "caller": call["caller"],
+                "method": call["method"],
+                "endpoint": call["endpoint"],
+                "requests": 0,
+                "bytes": 0,
+                "time": 0,
+            })
+            group["requests"] += 1
+            group["bytes"] += call["bytes_sent"] + call["bytes_received"]
+            group["time"] += call["time"]
+        return sorted(groups.values(), key=lambda group: group["requests"], reverse=True)
+
+    def warnings(self):
+        """
+        Finds methods and endpoints called repeatedly which have a bulk alternative.
+
+        :return: List of warning messages.
+        """
+        warnings = []
+        for group in self.groups():
+            if group["requests"] < self.repeat_threshold:
+                continue
+            if group["endpoint"] == "_api/contextinfo":
+                alternative = self.bulk_alternatives["digest"]
+            else:
+                alternative = self.bulk_alternatives.get(group["caller"])
+            if alternative:
+                warnings.append("{} made {} {} requests to {}, consider {}.".format(
+                    group["caller"], group["requests"], group["method"], group["endpoint"], alternative
+                ))
+        return warnings
+
+    def report(self):
+        """
+        Builds a cost report of the recorded requests.
+
+        :return: Report as String.
+        """
+        with self._lock:
+            calls = list(self.calls)
+        lines = [
+            "Round trips: {}, sent: {} B, received: {} B, request time: {:.3f} s, wall time: {:.3f} s".format(
+                len(calls),
+                sum(call["bytes_sent"] for call in calls),
+                sum(call["bytes_received"] for call in calls),
+                sum(call["time"] for call in calls),
+                self.wall_time
+            )
+        ]
+        for group in self.groups():
+            lines.append("{:>6} x {:<6} {:<40} {} ({} B, {:.3f} s)".format(
+                group["requests"], group["method"], group["caller"], group["endpoint"], group["bytes"], group["time"]
+            ))
+        for warning in self.warnings():
+            lines.append("WARNING: " + warning)
+        return "\n".join(lines)
+
+    def _record(self, method, url, *args, **kwargs):
+        caller = self._caller()
+        started = time.time()
+        response = None
+        try:
+            response = self._request(method, url, *args, **kwargs)
+            return response
+        finally:
+            data = kwargs.get("data")
+            with self._lock:
+                self.calls.append({
+                    "method": method,
+                    "url": url,
+                    "endpoint": _endpoint_template(url, self.connector.base_url),
+                    "caller": caller,
+                    "status": None if response is None else response.status_code,
+                    "bytes_sent": len(data) if isinstance(data, (bytes, bytearray, str)) else 0,
+                    "bytes_received": 0 if response is None else len(response.content),
+                    "time": time.time() - started,
+                })
+
+    def _caller(self):
+        """
+        Finds the outermost connector method on the stack, public methods are preferred.
+        Requests sent from worker threads are credited to the method which started the work,
+        functions nested in methods are not reported on their own.
+        """
+        public = None
+        private = None
+        for code, owner in _caller_stack(sys._getframe(2)):
+            if owner is not self.connector:
+                continue
+            method = getattr(type(owner), code.co_name, None)
+            if getattr(method, "__code__", None) is not code:
+                continue
+            if code.co_name.startswith("_"):
+                private = code.co_name
+            else:
+                public = code.co_name
+        return public or private or "session"
+
+
+class LookupResolver:
+    """
+    Joins lookup and person fields of list items locally.
+    Users and lookup target items are kept in in-memory indexes, loaded once and refreshed incrementally,
+    so a page of items is resolved with one request per target list for every 50 values not seen before.
+
+    Usage:
+        resolver = LookupResolver(connector)
+        for item in resolver.resolve_stream("Orders", connector.iter_list_items("Orders")):
+            print(item["Author"]["EMail"])
+    """
+
+    user_fields = ["Id", "Title", "EMail", "Name"]
+
+    def __init__(self, connector):
+        """
+        :param connector: Required, SharePointConnector used to read lists.
+        """
+        self.connector = connector
+        # Indexes of items by id, by target list GUID, users are stored under "users".
+        self.indexes = {"users": {}}
+        # Fields loaded into an index, by target list GUID.
+        self.index_fields = {"users": self.user_fields}
+        # Latest Modified value seen in an index, used by refresh.
+        self.modified = {}
+        # Lookup and person fields by list name.
+        self.list_fields = {}
+        self._lock = threading.Lock()
+
+    def load(self, list_name):
+        """
+        Loads the User Information list and all lookup target lists of given list into the indexes.
+
+        :param list_name: Required, name of the list which items will be resolved.
+        :return: Number of loaded items.
+        """
+        count = 0
+        for target in {field["target"] for field in self._fields(list_name)} | {"users"}:
+            count += self._load(target)
+        return count
+
+    def refresh(self):
+        """
+        Downloads users and lookup target items modified since the last load or refresh.
+
+        :return: Number of downloaded items.
+        """
+        count = 0
+        for target in list(self.indexes):
+            if target in self.modified:
+                count += self._load(target, "Modified gt datetime'{}'".format(self.modified[target]))
+        return count
+
+    def resolve(self, list_name, items):
+        """
+        Replaces lookup and person values of a page of items with the referenced items.
+        For every field, e.g. "Author", the value of "AuthorId" is resolved into "Author"
+        as a dictionary, or a list of dictionaries for multi value fields.
+
+        :param list_name: Required, name of the list the items come from.
+        :param items: Required, list of items as returned by get_list_items.
+        :return: The same list of items.
+        """
+        fields = self._fields(list_name)
+        missing = {}
+        for field in fields:
+            index = self.indexes.get(field["target"], {})
+            for item in items:
+                for item_id in _lookup_ids(item.get(field["name"] + "Id")):
+                    if item_id not in index:
+                        missing.setdefault(field["target"], set()).add(item_id)
+        for target, item_ids in missing.items():
+            self._load_ids(target, item_ids)
+
+        for field in fields:
+            index = self.indexes.get(field["target"], {})
+            for item in items:
+                value = item.get(field["name"] + "Id")
+                if field["multi"]:
+                    item[field["name"]] = [index.get(item_id) for item_id in _lookup_ids(value)]
+                elif value is not None:
+                    item[field["name"]] = index.get(value)
+        return items
+
+    def resolve_stream(self, list_name, items, page_size=500):
+        """
+        Resolves lookup and person values of a stream of items, page by page.
+
+        :param list_name: Required, name of the list the items come from.
+        :param items: Required, iterable of items, e.g. iter_list_items.
+        :param page_size: Optional, number of items resolved together.
+        :return: Generator of resolved items.
+        """
+        page = []
+        for item in items:
+            page.append(item)
+            if len(page) >= page_size:
+                for resolved in self.resolve(list_name, page):
+                    yield resolved
+                page = []
+        if page:
+            for resolved in self.resolve(list_name, page):
+                yield resolved
+
+    def _fields(self, list_name):
+        if list_name not in self.list_fields:
+            fields = []
+            for field in self.connector.get_list_fields(list_name) or []:
+                if field["FieldTypeKind"] not in (7, 20) or field.get("Hidden") or not field.get("LookupList"):
+                    continue
+                if field["FieldTypeKind"] == 20:
+                    target = "users"
+                else:
+                    target = field["LookupList"].strip("{}").lower()
+                    with self._lock:
+                        columns = self.index_fields.setdefault(target, ["Id"])
+                        if field["LookupField"] not in columns:
+                            columns.append(field["LookupField"])
+                            # Items loaded before lack the new column, they are loaded again when resolved.
+                            self.indexes.pop(target, None)
+                            self.modified.pop(target, None)
+                fields.append({
+                    "name": field.get("EntityPropertyName") or field["InternalName"],
+                    "target": target,
+                    "multi": bool(field.get("AllowMultipleValues")),
+                })
+            self.list_fields[list_name] = fields
+        return self.list_fields[list_name]
+
+    def _query(self, target, filter):
+        if target == "users":
+            query = "_api/web/SiteUserInfoList/items"
+        else:
+            query = "_api/web/lists(guid'{}')/items".format(target)
+        query += "?$select={}&$top=5000".format(",".join(self.index_fields[target] + ["Modified"]))
+        if filter:
+            query += "&$filter={}".format(filter)
+        return query
+
+    def _load(self, target, filter=None):
+        count = 0
+        for page in self.connector.iter_query_pages(self._query(target, filter)):
+            self._store(target, page)
+            count += len(page)
+        return count
+
+    def _load_ids(self, target, item_ids, chunk_size=50):
+        item_ids = sorted(item_ids)
+        for start in range(0, len(item_ids), chunk_size):
+            self._load(
+                target,
+                " or ".join("Id eq {}".format(item_id) for item_id in item_ids[start:start + chunk_size])
+            )
+        # Ids which do not exist anymore are remembered, so they are not requested again.
+        with self._lock:
+            index = self.indexes.setdefault(target, {})
+            for item_id in item_ids:
+                index.setdefault(item_id, None)
+
+    def _store(self, target, items):
+        columns = self.index_fields[target]
+        with self._lock:
+            index = self.indexes.setdefault(target, {})
+            for item in items:
+                index[item["Id"]] = {column: item.get(column) for column in columns}
+                if item.get("Modified") and item["Modified"] > self.modified.get(target, ""):
+                    self.modified[target] = item["Modified"]
+
+
+class MultiSiteConnector:
+    """
+    Runs the same read operation against many SharePoint sites concurrently.
+    Concurrency is limited globally and per host, failures and timings are reported per site.
+
+    Usage:
+        sites = MultiSiteConnector("login", "password", ["https://host/sites/a", "https://host/sites/b"])
+        for outcome in sites.run("get_list_items", list_name="Orders"):
+            print(outcome["site"], outcome["time"], outcome["error"] or len(outcome["result"]))
+        for site, item in sites.stream("iter_list_items", "Orders"):
+            print(site, item["Id"])
+    """
+
+    def __init__(self, login, password, base_urls, domain="eur", max_workers=16, per_host=4):
+        """
+        :param login: Required, login used for all sites.
+        :param password: Required, password used for all sites.
+        :param base_urls: Required, list of site urls.
+        :param domain: Optional, domain of the login.
+        :param max_workers: Optional, maximum number of sites read at the same time.
+        :param per_host: Optional, maximum number of sites of one host read at the same time.
+        """
+        if max_workers < 1 or per_host < 1:
+            raise AttributeError("max_workers and per_host need to be at least 1.")
+        self.connectors = {
+            base_url: SharePointConnector(login, password, base_url, domain) for base_url in base_urls
+        }
+        self.max_workers = max_workers
+        self.per_host = per_host
+        # Outcomes of the last stream by site url, see stream.
+        self.outcomes = {}
+
+    def run(self, operation, *args, **kwargs):
+        """
+        Runs an operation for every site and yields outcomes as soon as sites finish.
+        Generators returned by the operation, e.g. iter_list_items, are read to the end in the worker,
+        use stream to receive their items as they are read.
+
+        :param operation: Required, name of a SharePointConnector method or a function taking a connector.
+        :param args: Optional, arguments of the method.
+        :param kwargs: Optional, keyword arguments of the method.
+        :return: Generator of dictionaries with site, result, error and time of every site.
+        """
+        def run_site(base_url):
+            started = time.time()
+            outcome = {"site": base_url, "result": None, "error": None, "time": None}
+            try:
+                result = self._call(base_url, operation, args, kwargs)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+                outcome["result"] = result
+            except Exception as error:
+                print("Site {} failed: {}".format(base_url, error))
+                outcome["error"] = error
+            outcome["time"] = time.time() - started
+            return outcome
+
+        return self._scheduled(run_site)
+
+    def stream(self, operation, *args, **kwargs):
+        """
+        Runs a read operation for every site and yields its items as soon as they are read, tagged with the site.
+        Items of different sites are interleaved, at most buffer_size items wait for the consumer.
+        A failing site does not stop the others, its error, number of items and time are kept in outcomes.
+
+        :param operation: Required, name of a SharePointConnector method or a function taking a connector,
+                          returning an iterable of items, e.g. "iter_list_items".
+        :param args: Optional, arguments of the method.
+        :param kwargs: Optional, keyword arguments of the method, buffer_size sets the number of buffered items.
+        :return: Generator of (site, item) tuples.
+        """
+        buffer = queue.Queue(maxsize=kwargs.pop("buffer_size", 1000))
+        stop = threading.Event()
+        end = object()
+        self.outcomes = {}
+
+        def put(record):
+            while not stop.is_set():
+                try:
+                    buffer.put(record, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_site(base_url):
+            started = time.time()
+            outcome = {"site": base_url, "items": 0, "error": None, "time": None}
+            try:
+                for item in self._call(base_url, operation, args, kwargs):
+                    if not put((base_url, item)):
+                        break
+                    outcome["items"] += 1
+            except Exception as error:
+                print("Site {} failed: {}".format(base_url, error))
+                outcome["error"] = error
+            outcome["time"] = time.time() - started
+            self.outcomes[base_url] = outcome
+            return outcome
+
+        def schedule():
+            try:
+                for _ in self._scheduled(read_site):
+                    if stop.is_set():
+                        break
+            finally:
+                put(end)
+
+        scheduler = threading.Thread(target=schedule)
+        scheduler.daemon = True
+        scheduler.start()
+        try:
+            while True:
+                record = buffer.get()
+                if record is end:
+                    return
+                yield record
+        finally:
+            stop.set()
+
+    def run_all(self, operation, *args, **kwargs):
+        """
+        Runs an operation for every site and waits for all of them.
+
+        :param operation: Required, name of a SharePointConnector method or a function taking a connector.
+        :return: Dictionary of outcomes by site url.
+        """
+        return {outcome["site"]: outcome for outcome in self.run(operation, *args, **kwargs)}
+
+    def _scheduled(self, task):
+        """
+        Helper function.
+        Runs task for every site url within the global and per host limits and yields its results as sites finish.
+        """
+        queues = {}
+        for base_url in self.connectors:
+            queues.setdefault(urlparse(base_url).netloc, deque()).append(base_url)
+        running_per_host = {host: 0 for host in queues}
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while queues or running:
+                # Sites are started round robin over hosts, so one big host does not block the others.
+                started = True
+                while started and len(running) < self.max_workers:
+                    started = False
+                    for host in list(queues):
+                        if len(running) >= self.max_workers:
+                            break
+                        if running_per_host[host] < self.per_host:
+                            future = executor.submit(task, queues[host].popleft())
+                            running[future] = host
+                            running_per_host[host] += 1
+                            started = True
+                        if not queues[host]:
+                            del queues[host]
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running_per_host[running.pop(future)] -= 1
+                    yield future.result()
+        finally:
+            for future in running:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _call(self, base_url, operation, args, kwargs):
+        connector = self.connectors[base_url]
+        if callable(operation):
+            return operation(connector, *args, **kwargs)
+        return getattr(connector, operation)(*args, **kwargs)
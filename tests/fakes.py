@@ -0,0 +1,74 @@
+import json
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None, text=None, headers=None):
+        self.status_code = status_code
+        self.text = json.dumps(data) if text is None else text
+        self.content = self.text.encode("utf-8")
+        self.headers = {"Retry-After": "0"} if headers is None else headers
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeSession:
+    """
+    Answers every request with the response of the first route which url part is contained in the url.
+    A route response may be a FakeResponse, a list of responses returned one by one,
+    or a function called with the method, url and keyword arguments of the request.
+    Requests are recorded as (method, url, kwargs) tuples.
+    """
+
+    def __init__(self, routes=()):
+        self.routes = list(routes)
+        self.requests = []
+
+    @property
+    def urls(self):
+        return [url for _, url, _ in self.requests]
+
+    def request(self, method, url, **kwargs):
+        # Headers are copied, as they may be changed for a repeated request.
+        self.requests.append((method, url, {key: dict(value) if isinstance(value, dict) else value
+                                            for key, value in kwargs.items()}))
+        for part, response in self.routes:
+            if part in url:
+                if isinstance(response, list):
+                    return response.pop(0)
+                if callable(response):
+                    return response(method, url, kwargs)
+                return response
+        raise AssertionError("Unexpected request {} {}".format(method, url))
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+def digest_route():
+    return "_api/contextinfo", FakeResponse(200, {"d": {"GetContextWebInformation": {"FormDigestValue": "DIGEST"}}})
+
+
+def batch_response(parts):
+    """
+    Builds the body of a $batch response from (status_code, data) tuples.
+    """
+    body = ""
+    for status, data in parts:
+        body += (
+            "--batchresponse_1\r\n"
+            "Content-Type: application/http\r\n"
+            "Content-Transfer-Encoding: binary\r\n"
+            "\r\n"
+            "HTTP/1.1 {} Status\r\n"
+            "CONTENT-TYPE: application/json;odata=verbose;charset=utf-8\r\n"
+            "\r\n"
+            "{}\r\n"
+        ).format(status, "" if data is None else json.dumps({"d": data}))
+    return body + "--batchresponse_1--\r\n"
@@ -0,0 +1,106 @@
+import re
+import unittest
+
+from easy_sharepoint import SharePointConnector
+from easy_sharepoint.easy_sharepoint import _parse_batch_response, _send_batch
+
+from fakes import FakeResponse, FakeSession, batch_response, digest_route
+
+
+class SendBatchTest(unittest.TestCase):
+    def send(self, operations):
+        session = FakeSession([("$batch", FakeResponse(200, text=batch_response([(200, None)] * len(operations))))])
+        results = _send_batch(session, "https://host/sites/a/", "DIGEST", operations)
+        _, url, kwargs = session.requests[0]
+        return results, url, kwargs["headers"], kwargs["data"].decode("utf-8")
+
+    def test_request_lines_are_percent_encoded(self):
+        _, _, _, body = self.send([
+            ("PUT", "_api/web/lists/GetByTitle('Customer Orders')/views/GetByTitle('All Items')", {"RowLimit": 1}),
+            ("GET", "_api/web/GetFileByServerRelativeUrl('/sites/a/Shared Documents/a b.docx')", None),
+        ])
+        request_lines = re.findall(r"^(?:GET|POST|PATCH|DELETE) .*$", body, re.M)
+        self.assertEqual(request_lines, [
+            "PATCH https://host/sites/a/_api/web/lists/GetByTitle('Customer%20Orders')/views/"
+            "GetByTitle('All%20Items') HTTP/1.1\r",
+            "GET https://host/sites/a/_api/web/GetFileByServerRelativeUrl('/sites/a/Shared%20Documents/a%20b.docx')"
+            " HTTP/1.1\r",
+        ])
+        for line in request_lines:
+            self.assertEqual(len(line.strip().split(" ")), 3)
+
+    def test_writes_are_grouped_in_changesets_and_gets_are_separate(self):
+        _, url, headers, body = self.send([
+            ("POST", "_api/web/lists", {"Title": "a"}),
+            ("DELETE", "_api/web/lists/GetByTitle('a')/items(1)", None),
+            ("GET", "_api/web/lists", None),
+            ("POST", "_api/web/lists", {"Title": "b"}),
+        ])
+        self.assertEqual(url, "https://host/sites/a/_api/$batch")
+        self.assertEqual(headers["X-RequestDigest"], "DIGEST")
+        batch_boundary = re.search(r'boundary="(.*)"', headers["Content-Type"]).group(1)
+        self.assertTrue(body.startswith("--" + batch_boundary + "\r\n"))
+        self.assertTrue(body.endswith("--" + batch_boundary + "--\r\n"))
+        self.assertEqual(len(re.findall(r"boundary=\"changeset_", body)), 2)
+        self.assertIn("DELETE https://host/sites/a/_api/web/lists/GetByTitle('a')/items(1) HTTP/1.1\r\n"
+                      "Accept: application/json;odata=verbose\r\n"
+                      "Content-Type: application/json;odata=verbose\r\n"
+                      "If-Match: *\r\n", body)
+        self.assertIn('{"Title": "b"}', body)
+
+    def test_failed_batch_returns_none(self):
+        session = FakeSession([("$batch", FakeResponse(403, text="forbidden"))])
+        self.assertIsNone(_send_batch(session, "https://host/", "DIGEST", [("GET", "_api/web", None)]))
+
+    def test_rejected_digest_is_refreshed_once(self):
+        session = FakeSession([("$batch", [
+            FakeResponse(403, text="expired"), FakeResponse(200, text=batch_response([(200, {"Id": 1})]))
+        ])])
+        results = _send_batch(session, "https://host/", "OLD", [("GET", "_api/web", None)], lambda: "NEW")
+        self.assertEqual(results, [(200, {"Id": 1})])
+        self.assertEqual([kwargs["headers"]["X-RequestDigest"] for _, _, kwargs in session.requests], ["OLD", "NEW"])
+        self.assertEqual(session.requests[0][2]["data"], session.requests[1][2]["data"])
+
+    def test_throttled_batch_is_repeated(self):
+        connector = SharePointConnector("login", "password", "https://host/sites/a/")
+        connector.session = FakeSession([digest_route(), ("$batch", [
+            FakeResponse(429, text="throttled"),
+            FakeResponse(200, text=batch_response([(201, {"Id": 1}), (204, None)])),
+        ])])
+        results = connector.batch([("POST", "_api/web/lists", {"Title": "a"}), ("DELETE", "_api/web/lists(1)", None)])
+        self.assertEqual(results, [(201, {"Id": 1}), (204, None)])
+        self.assertEqual(len([url for url in connector.session.urls if url.endswith("$batch")]), 2)
+
+
+class ParseBatchResponseTest(unittest.TestCase):
+    def test_statuses_and_bodies_in_order(self):
+        results = _parse_batch_response(batch_response([(201, {"Id": 1}), (204, None), (404, {"error": "x"})]))
+        self.assertEqual(results, [(201, {"Id": 1}), (204, None), (404, {"error": "x"})])
+
+    def test_changeset_response(self):
+        text = (
+            "--batchresponse_1\r\n"
+            "Content-Type: multipart/mixed; boundary=changesetresponse_2\r\n"
+            "\r\n"
+            "--changesetresponse_2\r\n"
+            "Content-Type: application/http\r\n"
+            "\r\n"
+            "HTTP/1.1 204 No Content\r\n"
+            "CONTENT-TYPE: application/json\r\n"
+            "\r\n"
+            "\r\n"
+            "--changesetresponse_2\r\n"
+            "Content-Type: application/http\r\n"
+            "\r\n"
+            "HTTP/1.1 201 Created\r\n"
+            "CONTENT-TYPE: application/json\r\n"
+            "\r\n"
+            '{"d": {"Id": 5}}\r\n'
+            "--changesetresponse_2--\r\n"
+            "--batchresponse_1--\r\n"
+        )
+        self.assertEqual(_parse_batch_response(text), [(204, None), (201, {"Id": 5})])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+import requests
+
+from easy_sharepoint import SharePointConnector
+
+from fakes import FakeResponse, FakeSession, batch_response, digest_route
+
+
+def folders_session(folders, batches):
+    return FakeSession([digest_route(), ("$batch", [FakeResponse(200, text=batch) for batch in batches])] + [
+        ("GetFolderByServerRelativeUrl('{}')".format(folder),
+         listing if isinstance(listing, FakeResponse) else FakeResponse(200, {"d": listing}))
+        for folder, listing in folders.items()
+    ])
+
+
+def batch_bodies(session):
+    return [kwargs["data"].decode("utf-8") for _, url, kwargs in session.requests if url.endswith("$batch")]
+
+
+def listing(files, folders=()):
+    return {
+        "Files": {"results": [{"ServerRelativeUrl": url, "ETag": etag} for url, etag in files]},
+        "Folders": {"results": [
+            {"ServerRelativeUrl": url, "Name": url.rsplit("/", 1)[-1], "ListItemAllFields": item}
+            for url, item in folders
+        ]},
+    }
+
+
+class FilesMetadataTest(unittest.TestCase):
+    def test_only_library_root_forms_folder_is_skipped(self):
+        session = folders_session({
+            "/Docs/Sub/Forms": listing([("/Docs/Sub/Forms/b.txt", "1")]),
+            "/Docs/Sub": listing([], [("/Docs/Sub/Forms", {"Id": 2})]),
+            "/Docs/Forms": listing([("/Docs/Forms/AllItems.aspx", "1")]),
+            "/Docs": listing([("/Docs/O'Neil a.txt", "1")], [("/Docs/Forms", {}), ("/Docs/Sub", {"Id": 1})]),
+        }, [batch_response([
+            (200, {"ServerRelativeUrl": "/Docs/O'Neil a.txt", "ETag": "1"}),
+            (200, {"ServerRelativeUrl": "/Docs/Sub/Forms/b.txt", "ETag": "1"}),
+        ])])
+        connector = SharePointConnector("login", "password", "https://host/sites/a/")
+        connector.session = session
+        files = connector.get_files_metadata("Docs", recursive=True)
+        self.assertEqual([file["ServerRelativeUrl"] for file in files], ["/Docs/O'Neil a.txt", "/Docs/Sub/Forms/b.txt"])
+        self.assertFalse([url for url in session.urls if "GetFolderByServerRelativeUrl('/Docs/Forms')" in url])
+        self.assertIn("GetFileByServerRelativeUrl('/Docs/O''Neil%20a.txt')", batch_bodies(session)[0])
+
+    def test_failed_fetch_drops_stale_metadata(self):
+        session = folders_session({"/Docs": listing([("/Docs/a.txt", "2"), ("/Docs/b.txt", "2")])}, [
+            batch_response([(404, {"error": "gone"}), (200, {"ServerRelativeUrl": "/Docs/b.txt", "ETag": "2"})]),
+        ])
+        connector = SharePointConnector("login", "password", "https://host/sites/a/")
+        connector.session = session
+        connector.file_metadata_cache = {
+            "/Docs/a.txt": ("1", {"ServerRelativeUrl": "/Docs/a.txt", "ETag": "1"}),
+            "/Docs/b.txt": ("1", {"ServerRelativeUrl": "/Docs/b.txt", "ETag": "1"}),
+        }
+        files = connector.get_files_metadata("Docs")
+        self.assertEqual(files, [{"ServerRelativeUrl": "/Docs/b.txt", "ETag": "2"}])
+        self.assertNotIn("/Docs/a.txt", connector.file_metadata_cache)
+
+    def test_failed_folder_listing_raises(self):
+        session = folders_session({
+            "/Docs/Sub": FakeResponse(500, {"error": "failed"}),
+            "/Docs": listing([("/Docs/a.txt", "1")], [("/Docs/Sub", {"Id": 1})]),
+        }, [])
+        connector = SharePointConnector("login", "password", "https://host/sites/a/")
+        connector.session = session
+        with self.assertRaises(requests.HTTPError):
+            connector.get_files_metadata("Docs", recursive=True)
+        self.assertFalse([url for url in session.urls if url.endswith("$batch")])
@@ -0,0 +1,68 @@
+import threading
+import time
+import unittest
+
+from easy_sharepoint import SharePointConnector
+
+from fakes import FakeResponse, FakeSession
+
+FOLLOWERS = 4
+
+
+class CoalesceGetsTest(unittest.TestCase):
+    def setUp(self):
+        self.connector = SharePointConnector("login", "password", "https://host/sites/a/", coalesce_gets=True)
+        self.release = threading.Event()
+
+    def slow(self, response):
+        def answer(method, url, kwargs):
+            # Keeps the first call in flight until all followers are waiting for it.
+            self.release.wait(5)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return answer
+
+    def get_concurrently(self):
+        outcomes = [None] * (FOLLOWERS + 1)
+
+        def get(index):
+            try:
+                outcomes[index] = self.connector._get("https://host/sites/a/_api/web")
+            except Exception as error:
+                outcomes[index] = error
+
+        threads = [threading.Thread(target=get, args=(index,)) for index in range(FOLLOWERS + 1)]
+        for thread in threads:
+            thread.start()
+        while self.connector.get_stats["requests"] < FOLLOWERS + 1:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_identical_gets_share_one_call(self):
+        response = FakeResponse(200, {"d": {}})
+        self.connector.session = FakeSession([("_api/web", self.slow(response))])
+        outcomes = self.get_concurrently()
+        self.assertEqual(outcomes, [response] * (FOLLOWERS + 1))
+        self.assertEqual(len(self.connector.session.requests), 1)
+        self.assertEqual(self.connector.get_stats, {"requests": FOLLOWERS + 1, "coalesced": FOLLOWERS})
+
+    def test_error_of_the_call_reaches_every_caller(self):
+        error = ConnectionError("reset")
+        self.connector.session = FakeSession([("_api/web", self.slow(error))])
+        self.assertEqual(self.get_concurrently(), [error] * (FOLLOWERS + 1))
+        self.assertEqual(len(self.connector.session.requests), 1)
+
+    def test_gets_are_not_shared_by_default(self):
+        connector = SharePointConnector("login", "password", "https://host/sites/a/")
+        connector.session = FakeSession([("_api/web", FakeResponse(200, {"d": {}}))])
+        connector._get("https://host/sites/a/_api/web")
+        connector._get("https://host/sites/a/_api/web")
+        self.assertEqual(len(connector.session.requests), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
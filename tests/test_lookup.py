@@ -0,0 +1,48 @@
+import unittest
+
+from easy_sharepoint import LookupResolver, SharePointConnector
+
+from fakes import FakeResponse, FakeSession
+
+
+def lookup_items(method, url, kwargs):
+    ids = [int(part.split(" ")[-1]) for part in url.split("$filter=")[1].split(" or ")]
+    return FakeResponse(200, {"d": {"results": [
+        {"Id": item_id, "Title": str(item_id), "Code": "C{}".format(item_id)} for item_id in ids
+    ]}})
+
+
+def lookup_field(name, lookup_field):
+    return FakeResponse(200, {"d": {"results": [{
+        "FieldTypeKind": 7, "LookupList": "{ABC}", "LookupField": lookup_field, "InternalName": name,
+    }]}})
+
+
+class LookupResolverTest(unittest.TestCase):
+    def test_missing_values_are_loaded_in_chunks(self):
+        connector = SharePointConnector("login", "password", "https://host/sites/a/")
+        connector.session = FakeSession([
+            ("/fields", lookup_field("Customer", "Title")),
+            ("lists(guid'abc')/items", lookup_items),
+        ])
+        items = [{"CustomerId": item_id} for item_id in range(1, 61)]
+        LookupResolver(connector).resolve("Orders", items)
+        self.assertEqual(items[59]["Customer"], {"Id": 60, "Title": "60"})
+        self.assertEqual(len([url for url in connector.session.urls if "/items" in url]), 2)
+
+    def test_new_lookup_column_reloads_the_target(self):
+        connector = SharePointConnector("login", "password", "https://host/sites/a/")
+        connector.session = FakeSession([
+            ("GetByTitle('Orders')/fields", lookup_field("Customer", "Title")),
+            ("GetByTitle('Invoices')/fields", lookup_field("Client", "Code")),
+            ("lists(guid'abc')/items", lookup_items),
+        ])
+        resolver = LookupResolver(connector)
+        orders = resolver.resolve("Orders", [{"CustomerId": 1}])
+        invoices = resolver.resolve("Invoices", [{"ClientId": 1}])
+        self.assertEqual(orders[0]["Customer"], {"Id": 1, "Title": "1"})
+        self.assertEqual(invoices[0]["Client"], {"Id": 1, "Title": "1", "Code": "C1"})
+
+
+if __name__ == "__main__":
+    unittest.main()
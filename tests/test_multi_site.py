@@ -0,0 +1,79 @@
+import threading
+import time
+import unittest
+
+from easy_sharepoint import MultiSiteConnector
+
+SITES = ["https://a/sites/1", "https://a/sites/2", "https://a/sites/3", "https://b/sites/1"]
+
+
+class MultiSiteConnectorTest(unittest.TestCase):
+    def test_limits_are_validated(self):
+        for limits in ({"max_workers": 0}, {"per_host": 0}):
+            with self.assertRaises(AttributeError):
+                MultiSiteConnector("login", "password", SITES, **limits)
+
+    def test_sites_are_started_round_robin_within_limits(self):
+        lock = threading.Lock()
+        running = {}
+        peaks = {"all": 0}
+        started = []
+
+        def read(connector):
+            host = connector.base_url.split("/")[2]
+            with lock:
+                started.append(connector.base_url)
+                running[host] = running.get(host, 0) + 1
+                peaks[host] = max(peaks.get(host, 0), running[host])
+                peaks["all"] = max(peaks["all"], sum(running.values()))
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+            return host
+
+        sites = MultiSiteConnector("login", "password", SITES, max_workers=2, per_host=1)
+        outcomes = sites.run_all(read)
+        self.assertEqual(sorted(outcomes), sorted(SITES))
+        self.assertEqual(peaks, {"all": 2, "a": 1, "b": 1})
+        self.assertIn("https://b/sites/1/", started[:2])
+
+    def test_failing_site_is_isolated(self):
+        def read(connector):
+            if connector.base_url == "https://a/sites/2/":
+                raise ValueError("site is down")
+            return [connector.base_url]
+
+        outcomes = MultiSiteConnector("login", "password", SITES).run_all(read)
+        self.assertIsInstance(outcomes["https://a/sites/2"]["error"], ValueError)
+        self.assertEqual(outcomes["https://a/sites/1"]["result"], ["https://a/sites/1/"])
+        self.assertEqual(len([outcome for outcome in outcomes.values() if outcome["error"] is None]), 3)
+
+    def test_stream_yields_items_as_they_are_read(self):
+        received = threading.Event()
+
+        def read(connector):
+            if connector.base_url == "https://a/sites/2/":
+                yield 1
+                raise ValueError("site is down")
+            yield 1
+            # The second item is read only after the consumer received the first one.
+            if connector.base_url == "https://b/sites/1/":
+                self.assertTrue(received.wait(5))
+            yield 2
+
+        sites = MultiSiteConnector("login", "password", SITES)
+        records = []
+        for site, item in sites.stream(read):
+            records.append((site, item))
+            if site == "https://b/sites/1":
+                received.set()
+        self.assertEqual(sorted(records), sorted(
+            [(site, item) for site in SITES for item in (1, 2) if site != "https://a/sites/2"] +
+            [("https://a/sites/2", 1)]
+        ))
+        self.assertIsInstance(sites.outcomes["https://a/sites/2"]["error"], ValueError)
+        self.assertEqual(sites.outcomes["https://b/sites/1"]["items"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import re
+import unittest
+
+from easy_sharepoint import PermissionHandler
+
+from fakes import FakeResponse, FakeSession, batch_response, digest_route
+
+EDIT = {"High": "0", "Low": str(1 | 2 | 4)}
+READ = {"High": "0", "Low": "1"}
+
+ITEMS = [
+    {"Id": 1, "HasUniqueRoleAssignments": False, "FileRef": "/L/a", "FileDirRef": "/L", "FSObjType": 0},
+    {"Id": 2, "HasUniqueRoleAssignments": True, "FileRef": "/L/secret", "FileDirRef": "/L", "FSObjType": 1},
+    {"Id": 3, "HasUniqueRoleAssignments": False, "FileRef": "/L/secret/b", "FileDirRef": "/L/secret", "FSObjType": 0},
+    {"Id": 4, "HasUniqueRoleAssignments": False, "FileRef": "/L/secret/sub", "FileDirRef": "/L/secret", "FSObjType": 1},
+    {"Id": 5, "HasUniqueRoleAssignments": False, "FileRef": "/L/secret/sub/c", "FileDirRef": "/L/secret/sub",
+     "FSObjType": 0},
+]
+
+
+def item_permissions(method, url, kwargs):
+    item_ids = re.findall(r"items\((\d+)\)", kwargs["data"].decode("utf-8"))
+    return FakeResponse(200, text=batch_response([(200, {"GetUserEffectivePermissions": READ})] * len(item_ids)))
+
+
+class PrefetchItemPermissionsTest(unittest.TestCase):
+    def test_items_inherit_from_nearest_unique_folder(self):
+        handler = PermissionHandler("login", "password", "https://host/sites/a")
+        handler.session = FakeSession([
+            ("GetUserEffectivePermissions", FakeResponse(200, {"d": {"GetUserEffectivePermissions": EDIT}})),
+            ("/items?", FakeResponse(200, {"d": {"results": ITEMS}})),
+            digest_route(),
+            ("$batch", item_permissions),
+        ])
+        self.assertEqual(handler.prefetch_item_permissions("user", "L"), 5)
+        batches = [kwargs["data"].decode("utf-8") for _, url, kwargs in handler.session.requests if "$batch" in url]
+        self.assertEqual(re.findall(r"items\((\d+)\)", "".join(batches)), ["2"])
+        results = handler.check_permissions([("user", "L", item_id) for item_id in range(1, 6)], "EditListItems")
+        self.assertEqual(results, [True, False, False, False, False])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import threading
+import unittest
+
+import requests
+
+from easy_sharepoint import SharePointConnector
+from easy_sharepoint.easy_sharepoint import _prefetch
+
+from fakes import FakeResponse, FakeSession
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_pages_keep_their_order(self):
+        for depth in (0, 2):
+            self.assertEqual(list(_prefetch((page for page in [[1], [2], [3]]), depth)), [[1], [2], [3]])
+
+    def test_closing_early_stops_the_producer(self):
+        produced = []
+        closed = threading.Event()
+
+        def pages():
+            try:
+                for number in range(100):
+                    produced.append(number)
+                    yield [number]
+            finally:
+                closed.set()
+
+        stream = _prefetch(pages(), 2)
+        self.assertEqual(next(stream), [0])
+        stream.close()
+        self.assertTrue(closed.wait(5))
+        # The consumed page, a full buffer and the page waiting to be put into it.
+        self.assertLessEqual(len(produced), 4)
+
+    def test_error_of_the_producer_reaches_the_consumer(self):
+        def pages():
+            yield [1]
+            raise ValueError("page 2")
+
+        stream = _prefetch(pages(), 2)
+        self.assertEqual(next(stream), [1])
+        with self.assertRaises(ValueError):
+            next(stream)
+
+
+class IterFolderFilesTest(unittest.TestCase):
+    def test_failed_page_raises(self):
+        connector = SharePointConnector("login", "password", "https://host/sites/a/")
+        connector.session = FakeSession([
+            ("$skip=0", FakeResponse(200, {"d": {"results": [{"Name": "a"}, {"Name": "b"}]}})),
+            ("$skip=2", FakeResponse(500, {"error": "failed"})),
+        ])
+        files = []
+        with self.assertRaises(requests.HTTPError):
+            for file in connector.iter_folder_files("Docs", page_size=2, prefetch=1):
+                files.append(file["Name"])
+        self.assertEqual(files, ["a", "b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
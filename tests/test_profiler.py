@@ -0,0 +1,65 @@
+import unittest
+
+from easy_sharepoint import ConnectorProfiler, SharePointConnector
+from easy_sharepoint.easy_sharepoint import _endpoint_template
+
+from fakes import FakeResponse, FakeSession, digest_route
+
+
+class ConnectorProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.connector = SharePointConnector("login", "password", "https://host/sites/a")
+        self.connector.session = FakeSession([
+            digest_route(),
+            ("CopyTo", FakeResponse(200, {"d": {}})),
+            ("/items?$top", FakeResponse(200, {"d": {"results": [{"Id": 1}], "__next": "https://host/sites/a/page2"}})),
+            ("page2", FakeResponse(200, {"d": {"results": [{"Id": 2}]}})),
+            ("/items", FakeResponse(201, {"d": {"Id": 1}})),
+            ("_api/web/lists", FakeResponse(200, {"d": {"results": []}})),
+        ])
+
+    def groups(self, profiler):
+        return [(group["caller"], group["method"], group["endpoint"], group["requests"]) for group in profiler.groups()]
+
+    def test_requests_are_grouped_by_caller_and_endpoint(self):
+        with ConnectorProfiler(self.connector, print_report=False) as profiler:
+            self.connector.get_all_lists()
+            self.connector.get_all_lists()
+        self.assertEqual(self.groups(profiler), [("get_all_lists", "GET", "_api/web/lists?$top", 2)])
+        self.assertEqual(profiler.warnings(), [])
+
+    def test_requests_of_worker_threads_are_credited_to_the_calling_method(self):
+        with ConnectorProfiler(self.connector, print_report=False) as profiler:
+            self.connector.copy_files([("a", "b{}".format(number)) for number in range(3)])
+            list(self.connector.iter_list_items("Orders", prefetch=1))
+        self.assertEqual(self.groups(profiler), [
+            ("copy_files", "POST",
+             "_api/web/GetFileByServerRelativeUrl('{}')/CopyTo(strNewUrl='{}',bOverwrite=true)", 3),
+            ("copy_files", "POST", "_api/contextinfo", 1),
+            ("iter_list_items", "GET", "_api/web/lists/GetByTitle('{}')/items?$top", 1),
+            ("iter_list_items", "GET", "page2", 1),
+        ])
+
+    def test_digest_per_write_is_reported(self):
+        with ConnectorProfiler(self.connector, repeat_threshold=3, print_report=False) as profiler:
+            for _ in range(3):
+                self.connector.create_new_list_item("Orders", {"Title": "a"})
+        self.assertEqual(profiler.warnings(), [
+            "create_new_list_item made 3 POST requests to _api/contextinfo, consider batch(), "
+            "which sends many writes with a single digest value.",
+            "create_new_list_item made 3 POST requests to _api/web/lists/GetByTitle('{}')/items, "
+            "consider upsert() or batch().",
+        ])
+
+    def test_endpoint_template(self):
+        self.assertEqual(
+            _endpoint_template(
+                "https://host/sites/a/_api/web/lists/GetByTitle('Orders')/items(12)?$select=Id,Title&$top=5",
+                "https://host/sites/a/"
+            ),
+            "_api/web/lists/GetByTitle('{}')/items({})?$select&$top"
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from easy_sharepoint import SharePointConnector
+
+from fakes import FakeResponse, FakeSession, batch_response, digest_route
+
+CUSTOMERS = {
+    "Title": "Customers",
+    "Fields": {"results": [{
+        "__metadata": {"type": "SP.FieldMultiLineText", "uri": "https://host/fields/1", "id": "1", "etag": "\"1\""},
+        "InternalName": "Notes",
+        "Title": "Notes",
+        "Required": True,
+    }]},
+    "Views": {"results": []},
+}
+
+
+class ProvisionListsTest(unittest.TestCase):
+    def test_failed_creation_is_reported_and_not_provisioned(self):
+        connector = SharePointConnector("login", "password", "https://host/sites/a/")
+        connector.session = FakeSession([
+            digest_route(),
+            ("_api/web/lists?$filter", FakeResponse(200, {"d": {"results": [CUSTOMERS]}})),
+            ("$batch", [
+                FakeResponse(200, text=batch_response([(500, {"error": "failed"})])),
+                FakeResponse(200, text=batch_response([(204, None)])),
+            ]),
+        ])
+        results = connector.provision_lists([
+            {"Title": "Orders", "views": [{"Title": "All Items", "fields": ["LinkTitle"]}]},
+            {"Title": "Customers", "fields": [{"Title": "Notes", "FieldTypeKind": 3, "Required": False}]},
+        ])
+        self.assertEqual(len(results), 2)
+        (request_type, query, _), status, _ = results[0]
+        self.assertEqual((request_type, query, status), ("POST", "_api/web/lists", 500))
+        (request_type, query, data), status, _ = results[1]
+        self.assertEqual((request_type, query, status), (
+            "PUT", "_api/web/lists/GetByTitle('Customers')/fields/GetByInternalNameOrTitle('Notes')", 204
+        ))
+        self.assertEqual(data, {"Required": False, "__metadata": {"type": "SP.FieldMultiLineText"}})
+
+
+if __name__ == "__main__":
+    unittest.main()
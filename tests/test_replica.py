@@ -0,0 +1,57 @@
+import unittest
+
+from easy_sharepoint import ListReplica, SharePointConnector
+
+from fakes import FakeResponse, FakeSession
+
+
+class MirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.fail_pages = False
+        connector = SharePointConnector("login", "password", "https://host/sites/a")
+        connector.session = FakeSession([
+            ("/fields", FakeResponse(200, {"d": {"results": [
+                {"InternalName": "Title", "EntityPropertyName": "Title", "FieldTypeKind": 2, "Indexed": True},
+            ]}})),
+            ("ListItemEntityTypeFullName", FakeResponse(200, {"d": {
+                "ListItemEntityTypeFullName": "SP.Data.OrdersListItem",
+            }})),
+            ("CurrentChangeToken", FakeResponse(200, {"d": {"CurrentChangeToken": {"StringValue": "token"}}})),
+            ("/items?$top", FakeResponse(200, {"d": {
+                "results": [{"Id": 1, "Title": "a"}],
+                "__next": "https://host/sites/a/page2",
+            }})),
+            ("page2", self.page2),
+        ])
+        self.replica = ListReplica(connector)
+
+    def page2(self, method, url, kwargs):
+        if self.fail_pages:
+            return FakeResponse(500, {"error": "failed"})
+        return FakeResponse(200, {"d": {"results": [{"Id": 2, "Title": "b"}]}})
+
+    def test_mirror(self):
+        self.assertEqual(self.replica.mirror("Orders"), 2)
+        self.assertEqual(self.replica.lookup("Orders", "Title", "b"), [{"Id": 2, "Title": "b"}])
+        self.assertIn("Orders", self.replica.staleness())
+
+    def test_incomplete_mirror_keeps_earlier_copy(self):
+        self.replica.mirror("Orders")
+        refreshed = self.replica.staleness()["Orders"]
+        self.fail_pages = True
+        with self.assertRaises(Exception):
+            self.replica.mirror("Orders")
+        self.assertEqual(len(self.replica.query("Orders")), 2)
+        self.assertGreaterEqual(self.replica.staleness()["Orders"], refreshed)
+        tables = [row[0] for row in self.replica.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        self.assertNotIn("list_Orders_staging", tables)
+
+    def test_incomplete_first_mirror_is_not_reported(self):
+        self.fail_pages = True
+        with self.assertRaises(Exception):
+            self.replica.mirror("Orders")
+        self.assertEqual(self.replica.staleness(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
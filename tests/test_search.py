@@ -0,0 +1,73 @@
+import unittest
+
+import requests
+
+from easy_sharepoint import SharePointConnector
+
+from fakes import FakeResponse, FakeSession
+
+
+def search_response(rows, total_rows, refiners=None):
+    return FakeResponse(200, {"d": {"query": {"PrimaryQueryResult": {
+        "RelevantResults": {
+            "RowCount": len(rows),
+            "TotalRows": total_rows,
+            "Table": {"Rows": {"results": [
+                {"Cells": {"results": [{"Key": "Path", "Value": path}]}} for path in rows
+            ]}},
+        },
+        "RefinementResults": refiners,
+    }}}})
+
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self.connector = SharePointConnector("login", "password", "https://host/sites/a")
+
+    def test_query_string(self):
+        self.connector.session = FakeSession([("_api/search/query", search_response([], 0))])
+        list(self.connector.search(
+            "Title:\"O'Neil report\"",
+            select_properties=["Path", "Title"],
+            sort_list="LastModifiedTime:descending",
+            refinement_filters="FileType:equals(\"docx\")",
+        ))
+        self.assertEqual(self.connector.session.urls, [
+            "https://host/sites/a/_api/search/query?querytext='Title%3A%22O%27%27Neil%20report%22'"
+            "&refinementfilters='FileType%3Aequals%28%22docx%22%29'&rowlimit=500&trimduplicates=false"
+            "&selectproperties='Path,Title'&sortlist='LastModifiedTime%3Adescending'&startrow=0"
+        ])
+
+    def test_pages_follow_start_row_until_total_rows(self):
+        self.connector.session = FakeSession([
+            ("startrow=0", search_response(["/a", "/b"], 3)),
+            ("startrow=2", search_response(["/c"], 3)),
+        ])
+        results = list(self.connector.search("report", row_limit=2))
+        self.assertEqual(results, [{"Path": "/a"}, {"Path": "/b"}, {"Path": "/c"}])
+        self.assertEqual(len(self.connector.session.requests), 2)
+
+    def test_failed_page_raises(self):
+        self.connector.session = FakeSession([
+            ("startrow=0", search_response(["/a", "/b"], 3)),
+            ("startrow=2", FakeResponse(500, {"error": "failed"})),
+        ])
+        results = []
+        with self.assertRaises(requests.HTTPError):
+            for result in self.connector.search("report", row_limit=2):
+                results.append(result)
+        self.assertEqual(results, [{"Path": "/a"}, {"Path": "/b"}])
+
+    def test_refiners(self):
+        self.connector.session = FakeSession([("_api/search/query", search_response([], 5, {"Refiners": {"results": [
+            {"Name": "FileType", "Entries": {"results": [{"RefinementValue": "docx", "RefinementCount": "5"}]}},
+        ]}}))])
+        refiners = self.connector.search_refiners("report", ["FileType", "Author"])
+        self.assertEqual(refiners, {"FileType": [{"RefinementValue": "docx", "RefinementCount": "5"}]})
+        self.assertEqual(self.connector.session.urls, [
+            "https://host/sites/a/_api/search/query?querytext='report'&rowlimit=0&refiners='FileType,Author'"
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+import requests
+
+from easy_sharepoint import SharePointConnector
+
+from fakes import FakeResponse, FakeSession, digest_route
+
+
+def refuse(method, url, kwargs):
+    raise requests.ConnectionError("connection reset")
+
+
+class TransferTest(unittest.TestCase):
+    def setUp(self):
+        self.connector = SharePointConnector("login", "password", "https://host/sites/a")
+
+    def test_failed_pair_does_not_lose_other_outcomes(self):
+        self.connector.session = FakeSession([
+            digest_route(),
+            ("boom", refuse),
+            ("CopyTo", FakeResponse(200, {"d": {}})),
+        ])
+        outcomes = self.connector.copy_files([("a", "b"), ("boom", "c")])
+        self.assertEqual([(outcome["source"], outcome["status"]) for outcome in outcomes], [("a", 200), ("boom", None)])
+        self.assertIsNone(outcomes[0]["error"])
+        self.assertIsInstance(outcomes[1]["error"], requests.ConnectionError)
+
+    def test_paths_are_escaped(self):
+        self.connector.session = FakeSession([digest_route(), ("MoveTo", FakeResponse(200, {"d": {}}))])
+        self.connector.move_files([("Shared Documents/O'Neil #1.docx", "Archive/100%.docx")])
+        self.assertEqual(self.connector.session.urls[-1], (
+            "https://host/sites/a/_api/web/GetFileByServerRelativeUrl('/Shared%20Documents/O''Neil%20%231.docx')"
+            "/MoveTo(newUrl='/Archive/100%25.docx',flags=1)"
+        ))
+
+
+if __name__ == "__main__":
+    unittest.main()
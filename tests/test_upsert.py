@@ -0,0 +1,42 @@
+import unittest
+
+from easy_sharepoint import SharePointConnector
+
+from fakes import FakeResponse, FakeSession
+
+
+class UpsertTest(unittest.TestCase):
+    def connector(self, responses):
+        connector = SharePointConnector("login", "password", "https://host/sites/a")
+        connector.session = FakeSession(responses)
+        return connector
+
+    def test_failed_page_aborts_upsert(self):
+        connector = self.connector([
+            ("ListItemEntityTypeFullName", FakeResponse(200, {"d": {"ListItemEntityTypeFullName": "SP.Data.L"}})),
+            ("/items?$top", FakeResponse(200, {"d": {
+                "results": [{"Id": 1, "Code": "A"}],
+                "__next": "https://host/sites/a/page2",
+            }})),
+            ("page2", FakeResponse(503, {"error": "throttled"})),
+        ])
+        with self.assertRaises(Exception):
+            connector.upsert("L", [{"Code": "A"}, {"Code": "B"}], "Code")
+        self.assertEqual(connector.session.urls.count("https://host/sites/a/page2"), connector.max_retries + 1)
+        self.assertFalse([url for url in connector.session.urls if url.endswith("$batch")])
+
+    def test_records_are_compared_only_on_their_fields(self):
+        connector = self.connector([
+            ("ListItemEntityTypeFullName", FakeResponse(200, {"d": {"ListItemEntityTypeFullName": "SP.Data.L"}})),
+            ("/items?$top", FakeResponse(200, {"d": {"results": [
+                {"Id": 1, "Code": "A", "Amount": 1.0, "Notes": "kept"},
+                {"Id": 2, "Code": "B", "Amount": 2.0, "Notes": "x"},
+            ]}})),
+        ])
+        summary = connector.upsert("L", [{"Code": "A", "Amount": 1}, {"Code": "B", "Amount": 2, "Notes": "x"}], "Code")
+        self.assertEqual(summary, {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 2, "failed": []})
+        self.assertFalse([url for url in connector.session.urls if url.endswith("$batch")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+import requests
+
+from easy_sharepoint import SharePointConnector
+
+from fakes import FakeResponse, FakeSession, digest_route
+
+LIST = "https://host/sites/a/_api/web/lists(guid'L')/RenderListDataAsStream"
+
+
+class ReadViewTest(unittest.TestCase):
+    def setUp(self):
+        self.connector = SharePointConnector("login", "password", "https://host/sites/a")
+
+    def test_pages_follow_next_href(self):
+        self.connector.session = FakeSession([
+            digest_route(),
+            ("?View=V", FakeResponse(200, {"Row": [{"ID": "1"}], "NextHref": "?Paged=TRUE&p_ID=1"})),
+            ("?Paged=TRUE&p_ID=1&View=V", FakeResponse(200, {"Row": [{"ID": "2"}]})),
+        ])
+        self.assertEqual(list(self.connector.read_view("L", "V")), [{"ID": "1"}, {"ID": "2"}])
+        self.assertEqual(self.connector.session.urls[1:], [LIST + "?View=V", LIST + "?Paged=TRUE&p_ID=1&View=V"])
+
+    def test_failed_page_raises(self):
+        self.connector.session = FakeSession([
+            digest_route(),
+            ("?View=V", FakeResponse(200, {"Row": [{"ID": "1"}], "NextHref": "?Paged=TRUE&p_ID=1&View=V"})),
+            ("p_ID=1", FakeResponse(500, {"error": "failed"})),
+        ])
+        rows = []
+        with self.assertRaises(requests.HTTPError):
+            for row in self.connector.read_view("L", "V"):
+                rows.append(row)
+        self.assertEqual(rows, [{"ID": "1"}])
+
+
+if __name__ == "__main__":
+    unittest.main()